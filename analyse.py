@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Analyse a file of positions, printing the best move, score, depth and node count of each.
+
+Positions are read one per line as JSON with the heights and pieces as rows of characters, as the
+player to move sees them (their workers 'A' and 'B', the opponent's 'O'), e.g.
+
+    {"heights": ["01000", "02100", "01020", "00100", "00000"], "pieces": ["     ", " A O ", "  O  ", "   B ", "     "]}
+
+or, with --records, taken from every turn of a game record file written by playGame. Results are
+written one JSON line per position in the same order as they are read, and both sides are streamed,
+so large inputs can be piped through, e.g.
+
+    python analyse.py positions.jsonl --depth 4 --processes 4 > analysis.jsonl"""
+
+import argparse
+import json
+import sys
+
+from santorini import analysePositions, readGameRecords, replayGame
+
+def readPositions(lines):
+    """Yield (heights, pieces) for each non-blank JSON line."""
+    for line in lines:
+        if not line.strip():
+            continue
+        position = json.loads(line)
+        yield ([[int(height) for height in row] for row in position['heights']],
+               [list(row) for row in position['pieces']])
+
+def recordPositions(path):
+    """Yield (heights, pieces) before every move of every game in a game record file."""
+    for record in readGameRecords(path):
+        for heights, pieces, playerIndex, move in replayGame(record):
+            yield heights, pieces
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the best move and score of many positions.')
+    parser.add_argument('input', nargs='?', default='-', help='file of JSON positions, or - for stdin')
+    parser.add_argument('--records', action='store_true', help='read the positions from a game record file')
+    parser.add_argument('--depth', type=int, default=4, help='negamax depth, or the deepest iteration with --time')
+    parser.add_argument('--time', type=int, help='search each position for this many milliseconds')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--in-flight', type=int, help='most positions being searched at once')
+    args = parser.parse_args()
+
+    if args.records:
+        positions = recordPositions(args.input)
+    elif args.input == '-':
+        positions = readPositions(sys.stdin)
+    else:
+        positions = readPositions(open(args.input))
+    for move, score, depth, nodes in analysePositions(positions, args.depth, args.time, args.processes, args.in_flight):
+        print(json.dumps({'move': move, 'score': score, 'depth': depth, 'nodes': nodes}))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
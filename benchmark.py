@@ -0,0 +1,145 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Benchmarks for the hot paths in santorini.py.
+
+Run with no arguments to print the results as JSON. Save them with --output and use --compare to
+check a later run against them, e.g.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+
+The comparison exits with status 1 if any rate is more than --tolerance slower than the baseline, or
+if the move generation counts differ (which means the move generator has changed behaviour)."""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from santorini import (HeightOrdering, KillerHistoryOrdering, Position, TranspositionTable, defensivePlayer,
+                       generateOrderedChildPositions, negamax, playFastGame, playGame, tryToClimb)
+
+# Mid-game positions as (heights, pieces) rows, with 'A' and 'B' to move.
+CORPUS = [
+    (['01000', '02100', '01020', '00100', '00000'], ['     ', ' A O ', '  O  ', '   B ', '     ']),
+    (['00110', '01210', '02110', '01100', '00000'], ['     ', ' O   ', ' A  B', '  O  ', '     ']),
+    (['10012', '21100', '02221', '11020', '00100'], ['    O', ' B   ', '   A ', '  O  ', '     ']),
+    (['00000', '01110', '01210', '01110', '00000'], ['A   O', '     ', '     ', '     ', 'O   B']),
+]
+
+PERFT_DEPTH = 2
+SEARCH_DEPTHS = [2, 3, 4, 5]
+GAME_PLAYERS = [tryToClimb, defensivePlayer]
+NUMBER_OF_GAMES = 20
+# Move ordering strategies for the search benchmark, by name.
+ORDERINGS = {'height': HeightOrdering, 'killerHistory': KillerHistoryOrdering}
+
+def corpusNodes():
+    """Return the corpus as (heights, pieces, color) nodes."""
+    nodes = []
+    for heightsStrs, piecesStrs in CORPUS:
+        heights = [[int(height) for height in row] for row in heightsStrs]
+        pieces = [list(row) for row in piecesStrs]
+        nodes.append((heights, pieces, -1))
+    return nodes
+
+def perft(node, depth):
+    """Count the nodes at the given depth below a node, expanding with generateOrderedChildPositions."""
+    if depth == 0:
+        return 1
+    return sum(perft(child, depth - 1) for child in generateOrderedChildPositions(node))
+
+def positionPerft(position, depth):
+    """Count the nodes at the given depth below a position, expanding with applyMove/undoMove."""
+    if depth == 0 or position.lastMoveWon():
+        return 1
+    count = 0
+    for move in position.generateMoves():
+        position.applyMove(move)
+        count += positionPerft(position, depth - 1)
+        position.undoMove(move)
+    return count
+
+def benchmarkMoveGeneration(nodes, depth):
+    results = {}
+    for name, countNodes in [('childPositions', lambda node: perft(node, depth)),
+                             ('position', lambda node: positionPerft(Position.fromLists(node[0], node[1]), depth + 1))]:
+        startTime = time.time()
+        counts = [countNodes(node) for node in nodes]
+        seconds = time.time() - startTime
+        results[name] = {'counts': counts, 'seconds': seconds, 'nodesPerSecond': sum(counts) / seconds}
+    return results
+
+def benchmarkSearch(nodes, depths, ordering='killerHistory'):
+    results = {}
+    for depth in depths:
+        startTime = time.time()
+        scores = [negamax(node, depth, -1000, 1000, -1, table=TranspositionTable(), ordering=ORDERINGS[ordering]())
+                  for node in nodes]
+        seconds = time.time() - startTime
+        results['depth{}'.format(depth)] = {'scores': scores, 'seconds': seconds, 'searchesPerSecond': len(nodes) / seconds}
+    return results
+
+def benchmarkGames(numberOfGames, seed=0, playGame=playGame):
+    random.seed(seed)
+    startTime = time.time()
+    winners = [playGame(GAME_PLAYERS) for gameIndex in range(numberOfGames)]
+    seconds = time.time() - startTime
+    return {'games': numberOfGames, 'winners': winners, 'seconds': seconds, 'gamesPerSecond': numberOfGames / seconds}
+
+def runBenchmarks(depths=SEARCH_DEPTHS, numberOfGames=NUMBER_OF_GAMES, ordering='killerHistory'):
+    nodes = corpusNodes()
+    return {
+        'python': platform.python_version(),
+        'ordering': ordering,
+        'moveGeneration': benchmarkMoveGeneration(nodes, PERFT_DEPTH),
+        'search': benchmarkSearch(nodes, depths, ordering),
+        'games': {'playGame': benchmarkGames(numberOfGames, playGame=lambda players: playGame(players, quiet=True)),
+                  'playFastGame': benchmarkGames(numberOfGames, playGame=playFastGame)},
+    }
+
+def compareResults(baseline, results, tolerance):
+    """Return a list of problems found comparing results against a baseline."""
+    problems = []
+    for section, rateName, checkName in [('moveGeneration', 'nodesPerSecond', 'counts'),
+                                         ('search', 'searchesPerSecond', 'scores'),
+                                         ('games', 'gamesPerSecond', None)]:
+        for name, baselineEntry in sorted(baseline.get(section, {}).items()):
+            entry = results[section].get(name)
+            if entry is None:
+                continue
+            if checkName is not None and entry[checkName] != baselineEntry[checkName]:
+                problems.append('{}.{}: {} changed from {} to {}'.format(section, name, checkName, baselineEntry[checkName], entry[checkName]))
+            ratio = entry[rateName] / baselineEntry[rateName]
+            print('{:<30} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(section + '.' + name, baselineEntry[rateName], entry[rateName], ratio))
+            if ratio < 1 - tolerance:
+                problems.append('{}.{}: {} fell from {:.1f} to {:.1f}'.format(section, name, rateName, baselineEntry[rateName], entry[rateName]))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark move generation, search and full games.')
+    parser.add_argument('--depths', default=','.join(str(depth) for depth in SEARCH_DEPTHS), help='comma separated negamax depths')
+    parser.add_argument('--ordering', choices=sorted(ORDERINGS), default='killerHistory', help='move ordering for the search')
+    parser.add_argument('--games', type=int, default=NUMBER_OF_GAMES, help='number of games to time')
+    parser.add_argument('--output', help='write the results to this file as well as stdout')
+    parser.add_argument('--compare', help='a results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed fractional slowdown when comparing')
+    args = parser.parse_args()
+
+    results = runBenchmarks([int(depth) for depth in args.depths.split(',')], args.games, args.ordering)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        problems = compareResults(baseline, results, args.tolerance)
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
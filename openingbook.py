@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Build the opening book consulted by the negamax players.
+
+The book holds a move for every set up position reachable by placing workers on the candidate squares
+(by default the nine squares away from the edge, where tryToClimb places them), and for the first
+turns of the games that start from them. Set up squares are chosen by minimax over every placement,
+scoring each starting position with a negamax search, and turn moves by negamaxPlayer. Positions are
+stored once for all their rotations and reflections, e.g.
+
+    python openingbook.py --depth 3 --plies 1
+
+writes openingbook.bin next to santorini.py, where the players find it. Each extra ply multiplies
+the work by the number of moves available, about fifty."""
+
+import argparse
+import time
+
+from santorini import (OPENING_BOOK_PATH, SYMMETRY_SQUARES, EMPTY, OPPONENT, PIECES, Position, TranspositionTable,
+                       bookKey, coordsOf, encodeBookMove, negamaxPlayer, searchNegamax, squareOf, transformMove,
+                       writeOpeningBook)
+
+INNER_SQUARES = [squareOf(x, y) for y in range(1, 4) for x in range(1, 4)]
+
+def setUpLists(placed):
+    """Return the heights and pieces for a partly set up board, as seen by the player placing next.
+    placed lists the squares of the workers placed so far, first player's first."""
+    player = len(placed) // 2
+    heights = [[0] * 5 for i in range(5)]
+    pieces = [[EMPTY] * 5 for i in range(5)]
+    for index, square in enumerate(placed):
+        x, y = coordsOf(square)
+        pieces[y][x] = PIECES[index % 2] if index // 2 == player else OPPONENT
+    return heights, pieces
+
+def addSetUpMoves(book, candidates, depth, table):
+    """Add the best set up square for every position reachable by placing on the candidate squares.
+    Return the starting positions reached, as Positions with the first player to move."""
+    values = {}
+    startingPositions = {}
+
+    def setUpValue(placed):
+        # The value of a partly set up board to the first player, with both sides placing their best.
+        if len(placed) == 4:
+            position = Position([0] * 25, [placed[:2], placed[2:]])
+            key = position.canonicalHash()[0]
+            if key not in startingPositions:
+                startingPositions[key] = position
+            return searchNegamax(position, depth, -1000, 1000, table)
+        key, symmetry = bookKey(*setUpLists(placed))
+        if key not in values:
+            sign = 1 if len(placed) < 2 else -1
+            bestScore, bestSquare = None, None
+            for square in candidates:
+                if square in placed:
+                    continue
+                score = sign * setUpValue(placed + [square])
+                if bestScore is None or score > bestScore:
+                    bestScore, bestSquare = score, square
+            book[key] = encodeBookMove(coordsOf(SYMMETRY_SQUARES[symmetry][bestSquare]), True)
+            values[key] = sign * bestScore
+        return values[key]
+
+    setUpValue([])
+    return list(startingPositions.values())
+
+def addTurnMoves(book, positions, depth, plies):
+    """Add negamaxPlayer's move for each position and, for plies greater than one, for every position
+    reachable from them in up to plies turns."""
+    for ply in range(plies):
+        nextPositions = {}
+        for position in positions:
+            heights, pieces = position.toLists()
+            key, symmetry = bookKey(heights, pieces)
+            if key in book:
+                continue
+            move = negamaxPlayer(heights, pieces, False, startDepth=depth, openingBook=None)
+            book[key] = encodeBookMove(transformMove(move, symmetry), False)
+            if ply + 1 < plies:
+                for child in position.uniqueMoves(position.generateMoves()):
+                    if child[2] is None:
+                        continue
+                    position.applyMove(child)
+                    nextPositions.setdefault(position.canonicalHash()[0], position.copy())
+                    position.undoMove(child)
+        positions = list(nextPositions.values())
+
+def buildBook(depth=3, plies=1, candidates=INNER_SQUARES):
+    """Return a book as a dictionary from bookKey keys to encoded moves."""
+    book = {}
+    startingPositions = addSetUpMoves(book, candidates, depth, TranspositionTable())
+    addTurnMoves(book, startingPositions, depth, plies)
+    return book
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the opening book used by the negamax players.')
+    parser.add_argument('--depth', type=int, default=3, help='negamax depth used to score positions')
+    parser.add_argument('--plies', type=int, default=1, help='number of turns after set up to cover')
+    parser.add_argument('--all-squares', action='store_true', help='consider edge squares when setting up')
+    parser.add_argument('--output', default=OPENING_BOOK_PATH, help='where to write the book')
+    args = parser.parse_args()
+
+    startTime = time.time()
+    book = buildBook(args.depth, args.plies, range(25) if args.all_squares else INNER_SQUARES)
+    writeOpeningBook(book, args.output)
+    print('Wrote {} positions to {} in {:.1f}s'.format(len(book), args.output, time.time() - startTime))
+
+if __name__ == '__main__':
+    main()
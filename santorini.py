@@ -1,16 +1,38 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
-from random import randrange, sample, shuffle
-from collections import Counter, defaultdict
+from random import Random, randrange, sample, shuffle
+from collections import Counter, defaultdict, deque
 from itertools import combinations
 import re
+import math
+import mmap
+import os
+import struct
 from copy import deepcopy
 import time
+import multiprocessing
+import random
+import sqlite3
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Constants that can be changed when investigating players.
 NUMBER_OF_GAMES = 1
 OUTPUT_ALL_POSITIONS = True
+NUMBER_OF_PROCESSES = multiprocessing.cpu_count()
+# A file to append a GameRecord of every game to (see readGameRecords), or None.
+RECORD_GAMES_PATH = None
+# A SQLite file the negamax players keep search results in from one game to the next (see
+# EvaluationCache), or None.
+EVALUATION_CACHE_PATH = None
+# Score the depth one frontier of negamax with batchHeuristic (needs numpy). Scoring leaf by leaf is
+# usually quicker, since alpha-beta cuts most frontier nodes off after a few children.
+BATCH_FRONTIER = False
 
 # Constants that probably shouldn't be changed.
 DIRS = [(1,1),(1,0),(1,-1),(0,1),(0,-1),(-1,1),(-1,0),(-1,-1)]
@@ -21,6 +43,12 @@ MAX_HEIGHT = 4
 
 ### AI Helper Methods ###
 
+# For each square, indexed by 5 * y + x, the (direction, (destX, destY)) pairs for the neighbouring
+# squares that are on the board, in the order of DIRS.
+NEIGHBOURS = tuple(tuple((direction, (x + direction[0], y + direction[1])) for direction in DIRS
+                         if 0 <= x + direction[0] <= 4 and 0 <= y + direction[1] <= 4)
+                   for y in range(5) for x in range(5))
+
 class IllegalState(Exception):
     pass
 
@@ -49,42 +77,18 @@ def getOpponentCoordinates(pieces):
 
 def validMoves(heights, pieces, x, y):
     """Return a list of the directions that are valid for moving."""
-    options = []
-    for moveDir in DIRS:
-        destX, destY = x + moveDir[0], y + moveDir[1]
-        if destX < 0 or destX > 4 or destY < 0 or destY > 4:
-            continue
-        if pieces[destY][destX] != EMPTY:
-            continue
-        if heights[destY][destX] > heights[y][x] + 1:
-            continue
-        options.append(moveDir)
-    return options
+    maxHeight = heights[y][x] + 1
+    return [moveDir for moveDir, (destX, destY) in NEIGHBOURS[5 * y + x]
+            if pieces[destY][destX] == EMPTY and heights[destY][destX] <= maxHeight]
 
 def validBuilds(heights, pieces, x, y, pieceName):
     """Return a list of the directions that are valid for building."""
-    options = []
-    for buildDir in DIRS:
-        destX, destY = x + buildDir[0], y + buildDir[1]
-        if destX < 0 or destX > 4 or destY < 0 or destY > 4:
-            continue
-        if pieces[destY][destX] not in [EMPTY, pieceName]:
-            continue
-        if heights[destY][destX] == MAX_HEIGHT:
-            continue
-        options.append(buildDir)
-    return options
+    return [buildDir for buildDir, (destX, destY) in NEIGHBOURS[5 * y + x]
+            if (pieces[destY][destX] == EMPTY or pieces[destY][destX] == pieceName) and heights[destY][destX] != MAX_HEIGHT]
 
 def adjacentPieces(pieces, x, y):
     """Return a list of coordinates adjacent to a location that contain pieces."""
-    out = []
-    for moveDir in DIRS:
-        destX, destY = x + moveDir[0], y + moveDir[1]
-        if destX < 0 or destX > 4 or destY < 0 or destY > 4:
-            continue
-        if pieces[destY][destX] != EMPTY:
-            out.append((destX, destY))
-    return out
+    return [(destX, destY) for moveDir, (destX, destY) in NEIGHBOURS[5 * y + x] if pieces[destY][destX] != EMPTY]
 
 def validMovesByHeight(heights, pieces, x, y):
     """Return a map from a height to a list of the options to get to that height.
@@ -96,14 +100,10 @@ def validMovesByHeight(heights, pieces, x, y):
             2: [(-1, 0), (0,3)]
         }"""
     out = defaultdict(list)
-    for targetHeight in reversed(range(MAX_HEIGHT)):
-        if heights[y][x] < targetHeight - 1:
-            continue
-        moveDirs = validMoves(heights, pieces, x, y)
-        for moveDir in moveDirs:
-            destX, destY = x + moveDir[0], y + moveDir[1]
-            if heights[destY][destX] == targetHeight:
-                out[targetHeight].append((moveDir, (destX, destY)))
+    maxHeight = min(heights[y][x] + 1, MAX_HEIGHT - 1)
+    for moveDir, (destX, destY) in NEIGHBOURS[5 * y + x]:
+        if pieces[destY][destX] == EMPTY and heights[destY][destX] <= maxHeight:
+            out[heights[destY][destX]].append((moveDir, (destX, destY)))
     return out
 
 def getWinningMove(heights, pieces):
@@ -117,18 +117,536 @@ def getWinningMove(heights, pieces):
             return pieceName, moveDir, DIRS[0]
     return None
 
-def swapPieces(pieces):
-    """Swap the A and B for the O and O."""
-    pieceNameMap = {PIECES[0]: [OPPONENT], PIECES[1]: [OPPONENT], OPPONENT: list(PIECES)}
-    newPieces = []
-    for y in range(5):
-        newPieces.append([])
-        for x in range(5):
-            if pieces[y][x] != EMPTY:
-                newPieces[y].append(pieceNameMap[pieces[y][x]].pop())
-            else:
-                newPieces[y].append(EMPTY)
-    return newPieces
+### Bitboard Positions ###
+
+# Squares are numbered 5 * y + x and a set of squares is stored as an int with one bit per square.
+BOARD_MASK = (1 << 25) - 1
+
+def squareOf(x, y):
+    return 5 * y + x
+
+def coordsOf(square):
+    return square % 5, square // 5
+
+def bitsOf(mask):
+    """Yield the squares in a bit mask, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def _buildNeighbourTables():
+    neighbourMasks = []
+    directionBetween = {}
+    for square in range(25):
+        mask = 0
+        for direction, dest in NEIGHBOURS[square]:
+            mask |= 1 << squareOf(*dest)
+            directionBetween[(square, squareOf(*dest))] = direction
+        neighbourMasks.append(mask)
+    return tuple(neighbourMasks), directionBetween
+
+# The squares adjacent to each square, and the direction from a square to each of its neighbours.
+NEIGHBOUR_MASKS, DIRECTION_BETWEEN = _buildNeighbourTables()
+
+# How close each square is to the centre, as used by the heuristic.
+CENTRALITY = tuple(4 - abs(2 - x) - abs(2 - y) for y in range(5) for x in range(5))
+CENTRALITY_ARRAY = None if numpy is None else numpy.array(CENTRALITY)
+
+def _buildZobristKeys():
+    rng = Random(20170401)
+    heightKeys = tuple(tuple(rng.getrandbits(64) for height in range(MAX_HEIGHT + 1)) for square in range(25))
+    workerKeys = tuple(tuple(rng.getrandbits(64) for square in range(25)) for player in range(2))
+    return heightKeys, workerKeys, rng.getrandbits(64)
+
+# Random keys for Zobrist hashing: one per (square, height), one per (player, square) and one for player 1 to move.
+ZOBRIST_HEIGHTS, ZOBRIST_WORKERS, ZOBRIST_TO_MOVE = _buildZobristKeys()
+
+def _buildSymmetryTables():
+    coordinateMaps = [lambda x, y: (x, y), lambda x, y: (4 - y, x), lambda x, y: (4 - x, 4 - y),
+                      lambda x, y: (y, 4 - x), lambda x, y: (4 - x, y), lambda x, y: (x, 4 - y),
+                      lambda x, y: (y, x), lambda x, y: (4 - y, 4 - x)]
+    squareMaps = tuple(tuple(squareOf(*coordinateMap(*coordsOf(square))) for square in range(25))
+                       for coordinateMap in coordinateMaps)
+    directionMaps = []
+    for coordinateMap in coordinateMaps:
+        directionMap = {}
+        for direction in DIRS:
+            x, y = coordinateMap(2 + direction[0], 2 + direction[1])
+            directionMap[direction] = (x - 2, y - 2)
+        directionMaps.append(directionMap)
+    inverses = tuple(next(other for other in range(8) if squareMaps[other][squareMaps[symmetry][1]] == 1
+                          and squareMaps[other][squareMaps[symmetry][5]] == 5) for symmetry in range(8))
+    return squareMaps, tuple(directionMaps), inverses
+
+# The 8 rotations and reflections of the board: where each one sends each square and each direction,
+# and the index of the symmetry that undoes each one. Symmetry 0 is the identity.
+SYMMETRY_SQUARES, SYMMETRY_DIRECTIONS, SYMMETRY_INVERSES = _buildSymmetryTables()
+
+def _buildSymmetricZobristKeys():
+    def lanes(keyOf):
+        return sum(keyOf(symmetry) << (64 * symmetry) for symmetry in range(8))
+    heightKeys = tuple(tuple(lanes(lambda symmetry: ZOBRIST_HEIGHTS[SYMMETRY_SQUARES[symmetry][square]][height])
+                             for height in range(MAX_HEIGHT + 1)) for square in range(25))
+    workerKeys = tuple(tuple(lanes(lambda symmetry: ZOBRIST_WORKERS[player][SYMMETRY_SQUARES[symmetry][square]])
+                             for square in range(25)) for player in range(2))
+    return heightKeys, workerKeys, lanes(lambda symmetry: ZOBRIST_TO_MOVE)
+
+# The Zobrist keys of every symmetry packed into one int, 64 bits per symmetry, so that the hashes of
+# all 8 images of a position are kept up to date with one xor.
+SYMMETRIC_ZOBRIST_HEIGHTS, SYMMETRIC_ZOBRIST_WORKERS, SYMMETRIC_ZOBRIST_TO_MOVE = _buildSymmetricZobristKeys()
+LANE_MASK = (1 << 64) - 1
+LANE_SHIFTS = tuple(64 * symmetry for symmetry in range(8))
+
+def transformMove(move, symmetry):
+    """Map a (pieceName, moveDir, buildDir) move through one of the board symmetries."""
+    pieceName, moveDir, buildDir = move
+    directionMap = SYMMETRY_DIRECTIONS[symmetry]
+    return pieceName, directionMap[moveDir], directionMap[buildDir]
+
+def transformSquareMove(move, symmetry):
+    """Map a (fromSquare, toSquare, buildSquare) move through one of the board symmetries."""
+    squareMap = SYMMETRY_SQUARES[symmetry]
+    fromSquare, toSquare, buildSquare = move
+    return squareMap[fromSquare], squareMap[toSquare], None if buildSquare is None else squareMap[buildSquare]
+
+def canonicalPosition(heights, pieces):
+    """Return (heights, pieces, symmetry) where heights and pieces are the smallest of the 8 images of
+    the position and symmetry is the one that maps the position onto it. A move chosen in the
+    canonical position is played here as transformMove(move, SYMMETRY_INVERSES[symmetry])."""
+    best = None
+    for symmetry in range(8):
+        squareMap = SYMMETRY_SQUARES[symmetry]
+        newHeights = [[0] * 5 for i in range(5)]
+        newPieces = [[EMPTY] * 5 for i in range(5)]
+        for y in range(5):
+            for x in range(5):
+                newX, newY = coordsOf(squareMap[squareOf(x, y)])
+                newHeights[newY][newX] = heights[y][x]
+                newPieces[newY][newX] = pieces[y][x]
+        if best is None or (newHeights, newPieces) < best[:2]:
+            best = (newHeights, newPieces, symmetry)
+    return best
+
+class Position(object):
+    """A mutable board stored as bit masks.
+
+    levels[h] is the set of squares at height h and occupied[player] the set of squares holding that
+    player's workers. toMove is the player whose turn it is; in the list format their pieces are 'A'
+    and 'B' and the other player's are 'O'. The flat heights list and the workers lists hold the same
+    information for reading single squares. Turns are played with applyMove and taken back with
+    undoMove, so a search can walk the game tree without copying the board. Both keep these up to date
+    in constant time: hash, the Zobrist hash of the position; heightScores and centralityScores, the
+    sums of squared heights and of CENTRALITY under each player's workers, from which the evaluation is
+    read; and won, whether the player who just moved is standing at height MAX_HEIGHT - 1."""
+
+    def __init__(self, heights, workers, toMove=0):
+        self.heights = list(heights)
+        self.workers = [list(workers[0]), list(workers[1])]
+        self.toMove = toMove
+        self.levels = [0] * (MAX_HEIGHT + 1)
+        for square, height in enumerate(self.heights):
+            self.levels[height] |= 1 << square
+        self.occupied = [0, 0]
+        for player in range(2):
+            for square in self.workers[player]:
+                self.occupied[player] |= 1 << square
+        self.hash = ZOBRIST_TO_MOVE if toMove else 0
+        self.symmetricHash = SYMMETRIC_ZOBRIST_TO_MOVE if toMove else 0
+        for square, height in enumerate(self.heights):
+            self.hash ^= ZOBRIST_HEIGHTS[square][height]
+            self.symmetricHash ^= SYMMETRIC_ZOBRIST_HEIGHTS[square][height]
+        for player in range(2):
+            for square in self.workers[player]:
+                self.hash ^= ZOBRIST_WORKERS[player][square]
+                self.symmetricHash ^= SYMMETRIC_ZOBRIST_WORKERS[player][square]
+        # The last result of canonicalHash, as (symmetricHash, result).
+        self.canonicalCache = (None, None)
+        self.heightScores = [sum(self.heights[square] ** 2 for square in self.workers[player]) for player in range(2)]
+        self.centralityScores = [sum(CENTRALITY[square] for square in self.workers[player]) for player in range(2)]
+        self.won = self.occupied[1 - toMove] & self.levels[MAX_HEIGHT - 1] != 0
+
+    @classmethod
+    def fromLists(cls, heights, pieces):
+        """Create a position from the 5x5 heights and pieces lists used by the players."""
+        workers = [[None, None], []]
+        for y in range(5):
+            for x in range(5):
+                if pieces[y][x] in PIECES:
+                    workers[0][PIECES.index(pieces[y][x])] = squareOf(x, y)
+                elif pieces[y][x] == OPPONENT:
+                    workers[1].append(squareOf(x, y))
+        if None in workers[0]:
+            raise IllegalState('Can\'t find piece on board.')
+        return cls([heights[y][x] for y in range(5) for x in range(5)], workers)
+
+    def toLists(self):
+        """Return the 5x5 heights and pieces lists for this position, as seen by the player to move."""
+        heights = [self.heights[5 * y:5 * y + 5] for y in range(5)]
+        pieces = [[EMPTY] * 5 for i in range(5)]
+        for pieceIndex, square in enumerate(self.workers[self.toMove]):
+            x, y = coordsOf(square)
+            pieces[y][x] = PIECES[pieceIndex]
+        for square in self.workers[1 - self.toMove]:
+            x, y = coordsOf(square)
+            pieces[y][x] = OPPONENT
+        return heights, pieces
+
+    def copy(self):
+        return Position(self.heights, self.workers, self.toMove)
+
+    def moveMask(self, square):
+        """Return the squares the worker on a square can move to."""
+        reachable = 0
+        for height in range(min(self.heights[square] + 2, MAX_HEIGHT)):
+            reachable |= self.levels[height]
+        return NEIGHBOUR_MASKS[square] & reachable & ~(self.occupied[0] | self.occupied[1])
+
+    def buildMask(self, fromSquare, toSquare):
+        """Return the squares a worker moving from fromSquare to toSquare can build on."""
+        blocked = (self.occupied[0] | self.occupied[1] | self.levels[MAX_HEIGHT]) & ~(1 << fromSquare)
+        return NEIGHBOUR_MASKS[toSquare] & ~blocked
+
+    def generateMoves(self):
+        """Return a list of (fromSquare, toSquare, buildSquare) for every turn available to the player to move.
+
+        Moving onto height MAX_HEIGHT - 1 wins immediately, so such moves appear once with a
+        buildSquare of None."""
+        moves = []
+        for fromSquare in self.workers[self.toMove]:
+            for toSquare in bitsOf(self.moveMask(fromSquare)):
+                if self.heights[toSquare] == MAX_HEIGHT - 1:
+                    moves.append((fromSquare, toSquare, None))
+                    continue
+                for buildSquare in bitsOf(self.buildMask(fromSquare, toSquare)):
+                    moves.append((fromSquare, toSquare, buildSquare))
+        return moves
+
+    def applyMove(self, move):
+        """Play a move for the player to move and pass the turn to the other player."""
+        fromSquare, toSquare, buildSquare = move
+        player = self.toMove
+        workers = self.workers[player]
+        workers[workers.index(fromSquare)] = toSquare
+        self.occupied[player] ^= (1 << fromSquare) | (1 << toSquare)
+        workerKeys = ZOBRIST_WORKERS[player]
+        self.hash ^= workerKeys[fromSquare] ^ workerKeys[toSquare] ^ ZOBRIST_TO_MOVE
+        workerKeys = SYMMETRIC_ZOBRIST_WORKERS[player]
+        self.symmetricHash ^= workerKeys[fromSquare] ^ workerKeys[toSquare] ^ SYMMETRIC_ZOBRIST_TO_MOVE
+        # Nothing is ever built under a worker, so only the moving worker changes the scores.
+        toHeight = self.heights[toSquare]
+        self.heightScores[player] += toHeight ** 2 - self.heights[fromSquare] ** 2
+        self.centralityScores[player] += CENTRALITY[toSquare] - CENTRALITY[fromSquare]
+        self.won = toHeight == MAX_HEIGHT - 1
+        if buildSquare is not None:
+            height = self.heights[buildSquare]
+            self.heights[buildSquare] = height + 1
+            self.levels[height] ^= 1 << buildSquare
+            self.levels[height + 1] ^= 1 << buildSquare
+            heightKeys = ZOBRIST_HEIGHTS[buildSquare]
+            self.hash ^= heightKeys[height] ^ heightKeys[height + 1]
+            heightKeys = SYMMETRIC_ZOBRIST_HEIGHTS[buildSquare]
+            self.symmetricHash ^= heightKeys[height] ^ heightKeys[height + 1]
+        self.toMove = 1 - player
+
+    def undoMove(self, move):
+        """Take back a move made with applyMove."""
+        fromSquare, toSquare, buildSquare = move
+        player = 1 - self.toMove
+        if buildSquare is not None:
+            height = self.heights[buildSquare]
+            self.heights[buildSquare] = height - 1
+            self.levels[height] ^= 1 << buildSquare
+            self.levels[height - 1] ^= 1 << buildSquare
+            heightKeys = ZOBRIST_HEIGHTS[buildSquare]
+            self.hash ^= heightKeys[height] ^ heightKeys[height - 1]
+            heightKeys = SYMMETRIC_ZOBRIST_HEIGHTS[buildSquare]
+            self.symmetricHash ^= heightKeys[height] ^ heightKeys[height - 1]
+        workers = self.workers[player]
+        workers[workers.index(toSquare)] = fromSquare
+        self.occupied[player] ^= (1 << fromSquare) | (1 << toSquare)
+        workerKeys = ZOBRIST_WORKERS[player]
+        self.hash ^= workerKeys[fromSquare] ^ workerKeys[toSquare] ^ ZOBRIST_TO_MOVE
+        workerKeys = SYMMETRIC_ZOBRIST_WORKERS[player]
+        self.symmetricHash ^= workerKeys[fromSquare] ^ workerKeys[toSquare] ^ SYMMETRIC_ZOBRIST_TO_MOVE
+        self.heightScores[player] += self.heights[fromSquare] ** 2 - self.heights[toSquare] ** 2
+        self.centralityScores[player] += CENTRALITY[fromSquare] - CENTRALITY[toSquare]
+        self.toMove = player
+        self.won = self.occupied[1 - player] & self.levels[MAX_HEIGHT - 1] != 0
+
+    def lastMoveWon(self):
+        """Return whether the player who just moved is standing on height MAX_HEIGHT - 1."""
+        return self.won
+
+    def isLegalMove(self, move):
+        """Return whether a (fromSquare, toSquare, buildSquare) move can be played, e.g. to check a move
+        suggested by a table before searching it without generating the others."""
+        fromSquare, toSquare, buildSquare = move
+        if fromSquare not in self.workers[self.toMove] or not self.moveMask(fromSquare) >> toSquare & 1:
+            return False
+        if self.heights[toSquare] == MAX_HEIGHT - 1:
+            return buildSquare is None
+        return buildSquare is not None and self.buildMask(fromSquare, toSquare) >> buildSquare & 1 == 1
+
+    def winningMove(self):
+        """Return a move that climbs to height MAX_HEIGHT - 1, or None if there isn't one."""
+        for square in self.workers[self.toMove]:
+            destinations = self.moveMask(square) & self.levels[MAX_HEIGHT - 1]
+            if destinations:
+                return square, next(bitsOf(destinations)), None
+        return None
+
+    def hasWinningMove(self):
+        """Return whether the player to move can move a worker up to height MAX_HEIGHT - 1."""
+        for square in self.workers[self.toMove]:
+            if self.moveMask(square) & self.levels[MAX_HEIGHT - 1]:
+                return True
+        return False
+
+    def canonicalHash(self):
+        """Return (key, symmetry): the smallest hash among the 8 images of the position, which is the
+        same for every position that is a rotation or reflection of this one, and the symmetry that
+        maps this position onto the image with that hash."""
+        symmetricHash = self.symmetricHash
+        if self.canonicalCache[0] != symmetricHash:
+            lanes = [(symmetricHash >> shift) & LANE_MASK for shift in LANE_SHIFTS]
+            key = min(lanes)
+            self.canonicalCache = (symmetricHash, (key, lanes.index(key)))
+        return self.canonicalCache[1]
+
+    def transformed(self, symmetry):
+        """Return a copy of the position mapped through one of the board symmetries."""
+        squareMap = SYMMETRY_SQUARES[symmetry]
+        heights = [0] * 25
+        for square, height in enumerate(self.heights):
+            heights[squareMap[square]] = height
+        workers = [[squareMap[square] for square in self.workers[player]] for player in range(2)]
+        return Position(heights, workers, self.toMove)
+
+    def symmetries(self):
+        """Return the symmetries that map the position onto itself, including the identity."""
+        return [symmetry for symmetry in range(8) if self._isFixedBy(symmetry)]
+
+    def _isFixedBy(self, symmetry):
+        squareMap = SYMMETRY_SQUARES[symmetry]
+        for square, height in enumerate(self.heights):
+            if self.heights[squareMap[square]] != height:
+                return False
+        for player in range(2):
+            if sorted(squareMap[square] for square in self.workers[player]) != sorted(self.workers[player]):
+                return False
+        return True
+
+    def uniqueMoves(self, moves):
+        """Return moves without those that are a symmetry of the position away from an earlier move in
+        the list. The moves removed lead to positions that mirror ones that are kept."""
+        symmetries = self.symmetries()[1:]
+        if len(symmetries) == 0:
+            return list(moves)
+        seen = set()
+        unique = []
+        for move in moves:
+            if move not in seen:
+                unique.append(move)
+                seen.update(transformSquareMove(move, symmetry) for symmetry in symmetries)
+        return unique
+
+    def evaluate(self):
+        """Score the position for the player to move, in the same way as heuristic."""
+        player, opponent = self.toMove, 1 - self.toMove
+        return (100 * (self.heightScores[player] - self.heightScores[opponent])
+                + self.centralityScores[player] - self.centralityScores[opponent])
+
+    def describeMove(self, move):
+        """Convert a move to the (pieceName, moveDir, buildDir) format returned by players."""
+        fromSquare, toSquare, buildSquare = move
+        pieceName = PIECES[self.workers[self.toMove].index(fromSquare)]
+        buildDir = DIRS[0] if buildSquare is None else DIRECTION_BETWEEN[(toSquare, buildSquare)]
+        return pieceName, DIRECTION_BETWEEN[(fromSquare, toSquare)], buildDir
+
+def packMove(move):
+    """Pack a (pieceName, moveDir, buildDir) move into 7 bits: the piece, then the index of each direction in DIRS."""
+    pieceName, moveDir, buildDir = move
+    return (PIECES.index(pieceName) << 6) | (DIRS.index(moveDir) << 3) | DIRS.index(buildDir)
+
+def unpackMove(code):
+    return PIECES[(code >> 6) & 1], DIRS[(code >> 3) & 7], DIRS[code & 7]
+
+### Opening Book ###
+
+# The book the search players consult before searching. It is built by openingbook.py and the players
+# carry on without it if the file doesn't exist.
+OPENING_BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openingbook.bin')
+OPENING_BOOK_MAGIC = b'SBK1'
+PIECE_CODES = {EMPTY: 0, 'A': 1, 'B': 2, OPPONENT: 3}
+
+def bookKey(heights, pieces):
+    """Return (key, symmetry) for looking a position up in a book, where key is 25 bytes describing
+    the canonical image of the position (see canonicalPosition) and symmetry maps the position onto it.
+    Positions during set up, which have fewer than four pieces, can be looked up too."""
+    canonicalHeights, canonicalPieces, symmetry = canonicalPosition(heights, pieces)
+    key = bytearray(4 * canonicalHeights[y][x] + PIECE_CODES[canonicalPieces[y][x]] for y in range(5) for x in range(5))
+    return bytes(key), symmetry
+
+def encodeBookMove(move, setUp):
+    """Pack a set up square (x, y) or a (pieceName, moveDir, buildDir) move into one byte."""
+    if setUp:
+        return 0x80 | squareOf(*move)
+    return packMove(move)
+
+def decodeBookMove(code):
+    if code & 0x80:
+        return coordsOf(code & 0x7f)
+    return unpackMove(code)
+
+def writeOpeningBook(book, path):
+    """Write a book, a dictionary from bookKey keys to encoded moves, in the canonical frame."""
+    with open(path, 'wb') as bookFile:
+        bookFile.write(struct.pack('<4sI', OPENING_BOOK_MAGIC, len(book)))
+        for key in sorted(book):
+            bookFile.write(key + struct.pack('<B', book[key]))
+
+def readOpeningBook(path):
+    """Read a book written by writeOpeningBook, returning an empty book if the file doesn't exist."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as bookFile:
+        data = bookFile.read()
+    magic, count = struct.unpack_from('<4sI', data)
+    if magic != OPENING_BOOK_MAGIC:
+        raise ValueError('Not an opening book: {}'.format(path))
+    book = {}
+    for index in range(count):
+        offset = 8 + 26 * index
+        book[data[offset:offset + 25]] = struct.unpack_from('<B', data, offset + 25)[0]
+    return book
+
+# Books that have been read, by path.
+_openingBooks = {}
+
+def openingBookMove(heights, pieces, setUp, path=OPENING_BOOK_PATH):
+    """Return the book move for a position, or None if it isn't in the book (or path is None)."""
+    if path is None:
+        return None
+    if path not in _openingBooks:
+        _openingBooks[path] = readOpeningBook(path)
+    book = _openingBooks[path]
+    if len(book) == 0:
+        return None
+    key, symmetry = bookKey(heights, pieces)
+    code = book.get(key)
+    if code is None or bool(code & 0x80) != bool(setUp):
+        return None
+    move = decodeBookMove(code)
+    inverse = SYMMETRY_INVERSES[symmetry]
+    if setUp:
+        return coordsOf(SYMMETRY_SQUARES[inverse][squareOf(*move)])
+    return transformMove(move, inverse)
+
+### Endgame Tablebase ###
+
+# The tablebase searches probe, built by tablebase.py. The search does without it if the file doesn't exist.
+TABLEBASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebase.bin')
+TABLEBASE_MAGIC = b'SEG1'
+
+def transformMask(mask, symmetry):
+    """Map a set of squares through one of the board symmetries."""
+    squareMap = SYMMETRY_SQUARES[symmetry]
+    transformed = 0
+    for square in bitsOf(mask):
+        transformed |= 1 << squareMap[square]
+    return transformed
+
+def canonicalMask(mask):
+    """Return (mask, symmetry) for the smallest image of a set of squares and the symmetry giving it."""
+    return min((transformMask(mask, symmetry), symmetry) for symmetry in range(8))
+
+def pairRank(first, second, count):
+    """Return the index of the pair first < second among the pairs of range(count) in lexicographic order."""
+    return first * (2 * count - first - 1) // 2 + second - first - 1
+
+def placementsIn(count):
+    """Return the number of ways of placing two workers for each player on count squares."""
+    return count * (count - 1) // 2 * (count - 2) * (count - 3) // 2
+
+def layoutIndex(heights, movers, opponents):
+    """Return the index of a state in its layout's table.
+
+    heights holds the heights of the layout's squares in square order, and movers and opponents the
+    indexes into it of each player's workers. The heights count in base MAX_HEIGHT, then the movers'
+    pair and the opponents' pair among the squares left."""
+    count = len(heights)
+    heightIndex = 0
+    for height in reversed(heights):
+        heightIndex = heightIndex * MAX_HEIGHT + height
+    first, second = sorted(movers)
+    rest = [index - (index > first) - (index > second) for index in sorted(opponents)]
+    placement = pairRank(first, second, count) * ((count - 2) * (count - 3) // 2) + pairRank(rest[0], rest[1], count - 2)
+    return heightIndex * placementsIn(count) + placement
+
+def encodeResult(won, plies):
+    """Pack a result for the player to move into a byte: won in plies turns, or lost in plies."""
+    return 2 * plies + (1 if won else 0)
+
+def decodeResult(code):
+    return code & 1 == 1, code >> 1
+
+def writeTablebase(tables, threshold, path):
+    """Write tables, a dictionary from canonical layout masks to bytearrays of encoded results."""
+    masks = sorted(tables)
+    offset = 9 + 12 * len(masks)
+    with open(path, 'wb') as tablebaseFile:
+        tablebaseFile.write(struct.pack('<4sBI', TABLEBASE_MAGIC, threshold, len(masks)))
+        for mask in masks:
+            tablebaseFile.write(struct.pack('<IQ', mask, offset))
+            offset += len(tables[mask])
+        for mask in masks:
+            tablebaseFile.write(bytes(tables[mask]))
+
+class Tablebase(object):
+    """Exact results for positions with at most threshold squares below MAX_HEIGHT.
+
+    The file is memory mapped, so only the pages of the tables that are probed are read. Each layout of
+    open squares is stored once for all its symmetries."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as tablebaseFile:
+            self.data = mmap.mmap(tablebaseFile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.threshold, count = struct.unpack_from('<4sBI', self.data)
+        if magic != TABLEBASE_MAGIC:
+            raise ValueError('Not a tablebase: {}'.format(path))
+        self.offsets = {}
+        for index in range(count):
+            mask, offset = struct.unpack_from('<IQ', self.data, 9 + 12 * index)
+            self.offsets[mask] = offset
+
+    def covers(self, position):
+        """Return whether the position has few enough open squares to be looked up."""
+        return bin(BOARD_MASK & ~position.levels[MAX_HEIGHT]).count('1') <= self.threshold
+
+    def probe(self, position):
+        """Return (won, plies) for the player to move, or None if the position's layout isn't stored."""
+        mask, symmetry = canonicalMask(BOARD_MASK & ~position.levels[MAX_HEIGHT])
+        offset = self.offsets.get(mask)
+        if offset is None:
+            return None
+        squares = list(bitsOf(mask))
+        inverseMap = SYMMETRY_SQUARES[SYMMETRY_INVERSES[symmetry]]
+        heights = [position.heights[inverseMap[square]] for square in squares]
+        squareMap = SYMMETRY_SQUARES[symmetry]
+        movers = [squares.index(squareMap[square]) for square in position.workers[position.toMove]]
+        opponents = [squares.index(squareMap[square]) for square in position.workers[1 - position.toMove]]
+        code = self.data[offset + layoutIndex(heights, movers, opponents)]
+        return decodeResult(code if isinstance(code, int) else ord(code))
+
+def loadTablebase(path=TABLEBASE_PATH):
+    """Return the Tablebase in a file, or None if there isn't one."""
+    if path is None or not os.path.exists(path):
+        return None
+    return Tablebase(path)
+
+# The tablebase probed by searchNegamax, or None.
+ENDGAME_TABLEBASE = loadTablebase()
 
 ### AI Algorithms ###
 
@@ -224,83 +742,80 @@ def defensivePlayer(heights, pieces, setUp):
                             return pieceName, moveDir, buildDir
     return buildAway(heights, pieces, setUp)
 
-def depthSearchPlayer(heights, pieces, setUp):
-    def getScore(heights, pieces, pieceName, moveDir, buildDir, remainingDepth, branchingFactor, maximiseScore):
-        """Evaluate the position and give it a score."""
-        x, y = findPiecePos(pieces, pieceName)
-        # Don't change original lists.
-        heights = deepcopy(heights)
-        pieces = deepcopy(pieces)
-        pieces[y][x] = EMPTY
-        pieces[y+moveDir[1]][x+moveDir[0]] = pieceName
-        heights[y+moveDir[1]+buildDir[1]][x+moveDir[0]+buildDir[0]] += 1
-        pieces = swapPieces(pieces)
-        # If can win then end search.
-        winningMove = getWinningMove(heights, pieces)
-        if winningMove != None:
-            return 1000 if maximiseScore else -1000
-        positionScore = 0
-        for y in range(5):
-            for x in range(5):
-                if pieces[y][x] in PIECES:
-                    positionScore -= 0.1 * heights[y][x] ** 2 + (4 - abs(2-x) - abs(2-y))
-                elif pieces[y][x] == OPPONENT:
-                    positionScore += 100 * heights[y][x] ** 2 + 1 * (4 - abs(2-x) - abs(2-y))
-        if remainingDepth == 0 or branchingFactor == 0:
-            return 500-positionScore if maximiseScore else 500+positionScore
-        bestScore = -1000 if maximiseScore else 1000
-        steps = 0
-        for pieceName in PIECES:
-            x, y = findPiecePos(pieces, pieceName)
-            movesByHeight = validMovesByHeight(heights, pieces, x, y)
-            # TODO Ensure we check at least some moves for each piece.
-            for targetHeight in reversed(range(MAX_HEIGHT)):
-                for moveDir, _ in movesByHeight[targetHeight]:
-                    if steps >= branchingFactor:
-                        break
-                    steps += 1
-                    buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-                    for buildDir in buildDirs:
-                        score = getScore(heights, pieces, pieceName, moveDir, buildDir, remainingDepth - 1, branchingFactor - 1, maximiseScore)
-                        if score > bestScore and maximiseScore or score < bestScore and not maximiseScore:
-                            bestScore = score
-                if steps >= branchingFactor:
-                    break
-        return 0.1 * positionScore + bestScore
+# The most positions depthSearchPlayer visits in one search.
+DEPTH_SEARCH_NODE_BUDGET = 20000
+
+def depthSearchPlayer(heights, pieces, setUp, stats=None, depth=3, nodeBudget=DEPTH_SEARCH_NODE_BUDGET):
+    """Choose a move by alpha-beta search to depth turns, scoring positions by height and centrality.
+    Once nodeBudget positions have been visited the rest are scored without looking further ahead."""
+    remainingNodes = [nodeBudget]
+
+    def getPositionScore(position, remainingDepth, alpha, beta):
+        """Score a position for the player choosing the move, who is player 0."""
+        if stats is not None:
+            stats.visit(position, remainingDepth)
+        remainingNodes[0] -= 1
+        maximiseScore = position.toMove == 0
+        # If either player has won or can win then end search.
+        if position.lastMoveWon() or position.hasWinningMove():
+            return 1000 if maximiseScore != position.lastMoveWon() else -1000
+        mover, player = 1 - position.toMove, position.toMove
+        positionScore = (100 * position.heightScores[mover] + position.centralityScores[mover]
+                         - 0.1 * position.heightScores[player] - position.centralityScores[player])
+        if maximiseScore:
+            positionScore = -positionScore
+        if remainingDepth == 0 or remainingNodes[0] <= 0:
+            return 500 + positionScore
+        # Search the children with the window shifted by this position's share of the score.
+        offset = 0.1 * positionScore
+        alpha, beta = alpha - offset, beta - offset
+        bestScore = None
+        if stats is not None:
+            stats.expandedNodes += 1
+        for move in orderedMoves(position):
+            if stats is not None:
+                stats.childrenSearched += 1
+            position.applyMove(move)
+            score = getPositionScore(position, remainingDepth - 1, alpha, beta)
+            position.undoMove(move)
+            if bestScore is None or (score > bestScore if maximiseScore else score < bestScore):
+                bestScore = score
+            if maximiseScore:
+                alpha = max(alpha, score)
+            else:
+                beta = min(beta, score)
+            if alpha >= beta:
+                if stats is not None:
+                    stats.cutoffs += 1
+                break
+        if bestScore is None:
+            # A player who can't move loses.
+            bestScore = -1000 if maximiseScore else 1000
+        return offset + bestScore
 
     if setUp:
         return tryToClimb(heights, pieces, setUp)
+    startTime = time.time()
     bestScore = -1000
     bestMove = defensivePlayer(heights, pieces, setUp)
-    for pieceName in PIECES:
-        x, y = findPiecePos(pieces, pieceName)
-        moveDirs = validMoves(heights, pieces, x, y)
-        for moveDir in moveDirs:
-            buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-            for buildDir in buildDirs:
-                score = getScore(heights, pieces, pieceName, moveDir, buildDir, 2, 9, False)
-                print(pieceName, moveDir, buildDir, score, 'BEST' if score > bestScore else '')
-                if score > bestScore:
-                    bestScore = score
-                    bestMove = (pieceName, moveDir, buildDir)
-                    if bestScore >= 1000:
-                        return bestMove
+    position = Position.fromLists(heights, pieces)
+    for move in orderedMoves(position):
+        position.applyMove(move)
+        score = getPositionScore(position, depth - 1, bestScore, float('inf'))
+        position.undoMove(move)
+        if score > bestScore:
+            bestScore = score
+            bestMove = position.describeMove(move)
+            if bestScore >= 1000:
+                break
+    if stats is not None:
+        stats.completedDepth = depth
+        stats.score = bestScore
+        stats.elapsedSeconds = time.time() - startTime
     return bestMove
 
 ### Start Negamax Player ###
 
-def scoreIfEndGame(node):
-    heights, pieces, color = node
-    for y in range(5):
-        for x in range(5):
-            if heights[y][x] == MAX_HEIGHT - 1:
-                if pieces[y][x] == OPPONENT:
-                    return color * -1000
-                elif pieces[y][x] in PIECES:
-                    # This shouldn't be able to happen.
-                    return color * 1000
-    return 0
-
 def heuristic(node, score):
     if score != 0:
         return score
@@ -314,184 +829,952 @@ def heuristic(node, score):
                 positionScore -= 100 * heights[y][x] ** 2 + (4 - abs(2-x) - abs(2-y))
     return color * positionScore
 
-def moveThenSwapPieces(pieces, pieceX, pieceY, moveDir):
-    pieceNameMap = {PIECES[0]: [OPPONENT], PIECES[1]: [OPPONENT], OPPONENT: list(PIECES)}
-    newPieces = [[EMPTY] * 5 for i in range(5)]
-    for y in range(5):
-        for x in range(5):
-            if x != pieceX or y != pieceY:
-                if pieces[y][x] != EMPTY:
-                    newPieces[y][x] = pieceNameMap[pieces[y][x]].pop()
-    newPieces[pieceY + moveDir[1]][pieceX + moveDir[0]] = OPPONENT
-    return newPieces
+def batchHeuristic(heights, owners):
+    """Score a batch of positions in the same way as heuristic.
 
-def moveDontSwapPieces(pieces, pieceX, pieceY, moveDir):
-    newPieces = [[EMPTY] * 5 for i in range(5)]
-    for y in range(5):
-        for x in range(5):
-            if x != pieceX or y != pieceY:
-                if pieces[y][x] != EMPTY:
-                    newPieces[y][x] = pieces[y][x]
-    newPieces[pieceY + moveDir[1]][pieceX + moveDir[0]] = pieces[pieceY][pieceX]
-    return newPieces
+    heights and owners are (N, 5, 5) or (N, 25) arrays, where owners is 1 for the player to move, -1
+    for the opponent and 0 for an empty square. Return the N scores, computed in one vectorised pass
+    when numpy is available."""
+    if numpy is not None:
+        heights = numpy.asarray(heights).reshape(-1, 25)
+        owners = numpy.asarray(owners).reshape(-1, 25)
+        return (owners * (100 * heights ** 2 + CENTRALITY_ARRAY)).sum(axis=1)
+    scores = []
+    for positionHeights, positionOwners in zip(heights, owners):
+        positionHeights, positionOwners = _flatten(positionHeights), _flatten(positionOwners)
+        scores.append(sum(positionOwners[square] * (100 * positionHeights[square] ** 2 + CENTRALITY[square])
+                          for square in range(25) if positionOwners[square] != 0))
+    return scores
 
-def generateOrderedChildPositions(node):
-    heights, pieces, color = node
-    newColor = -color
-    childPositionsByHeight = defaultdict(list)
-    for pieceName in PIECES:
-        x, y = findPiecePos(pieces, pieceName)
-        movesByHeight = validMovesByHeight(heights, pieces, x, y)
-        for targetHeight in reversed(range(MAX_HEIGHT)):
-            for moveDir, _ in movesByHeight[targetHeight]:
-                pieceHeight = heights[y + moveDir[1]][x + moveDir[0]]
-                newPieces = moveThenSwapPieces(pieces, x, y, moveDir)
-                buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-                for buildDir in buildDirs:
-                    newHeights = deepcopy(heights)
-                    newHeights[y + moveDir[1] + buildDir[1]][x + moveDir[0] + buildDir[0]] += 1
-                    childPositionsByHeight[pieceHeight].append((newHeights, newPieces, newColor))
-    orderedChildren = []
-    for height in reversed(sorted(childPositionsByHeight.keys())):
-        orderedChildren += childPositionsByHeight[height]
-    return orderedChildren
-
-def negamax(node, depth, alpha, beta, color):
+def _flatten(grid):
+    """Return a 5x5 grid as a flat list of 25 values, or a flat list unchanged."""
+    if len(grid) == 5:
+        return [value for row in grid for value in row]
+    return grid
+
+def evaluateChildren(position, moves):
+    """Return the evaluate() score of the position after each move, from the point of view of the
+    player to move there, as a list of ints. None of the moves may be winning moves."""
+    if numpy is None:
+        scores = []
+        for move in moves:
+            position.applyMove(move)
+            scores.append(position.evaluate())
+            position.undoMove(move)
+        return scores
+    count = len(moves)
+    moveArray = numpy.array(moves)
+    rows = numpy.arange(count)
+    heights = numpy.repeat(numpy.array([position.heights]), count, axis=0)
+    heights[rows, moveArray[:, 2]] += 1
+    # After the move it is the opponent's turn, so their workers count positively.
+    owners = numpy.zeros((count, 25), dtype=int)
+    owners[:, position.workers[1 - position.toMove]] = 1
+    owners[rows, moveArray[:, 1]] = -1
+    owners[:, position.workers[position.toMove]] = -1
+    owners[rows, moveArray[:, 0]] = 0
+    # Plain ints, as the scores go on into the transposition table, the evaluation cache and JSON.
+    return batchHeuristic(heights, owners).tolist()
+
+def searchFrontier(position, stats=None):
+    """Return (score, bestMove) for a depth one negamax search, evaluating every child in one batch.
+    Children the endgame tablebase covers get its exact scores, and stats (a SearchStats) is updated
+    as searchNegamax would for the children."""
+    moves = position.generateMoves()
+    for move in moves:
+        if move[2] is None:
+            return 1000, move
+    if stats is not None:
+        stats.expandedNodes += 1
+        stats.childrenSearched += len(moves)
+    if len(moves) == 0:
+        return -1000, None
+    startTime = time.time()
+    scores = evaluateChildren(position, moves)
+    if stats is not None:
+        stats.evaluationSeconds += time.time() - startTime
+    if ENDGAME_TABLEBASE is not None or stats is not None:
+        for index, move in enumerate(moves):
+            position.applyMove(move)
+            if stats is not None:
+                stats.visit(position, 0)
+            if ENDGAME_TABLEBASE is not None and ENDGAME_TABLEBASE.covers(position):
+                result = ENDGAME_TABLEBASE.probe(position)
+                if result is not None:
+                    if stats is not None:
+                        stats.tablebaseHits += 1
+                    scores[index] = 1000 if result[0] else -1000
+            position.undoMove(move)
+    bestIndex = min(range(len(moves)), key=lambda index: scores[index])
+    return -int(scores[bestIndex]), moves[bestIndex]
+
+def orderedMoves(position):
+    """Return the moves for the player to move, those that climb highest first."""
+    heights = position.heights
+    return sorted(position.generateMoves(), key=lambda move: -heights[move[1]])
+
+def generateOrderedChildPositions(node, ordering=None):
+    """Yield the (heights, pieces, color) children of a node, in the order given by a move ordering
+    strategy (by default the highest climbs first). Each child is only built when it is asked for, so
+    a search that stops early doesn't pay for the rest."""
     heights, pieces, color = node
-    score = scoreIfEndGame(node)
-    if depth == 0 or score != 0:
-        return color * heuristic(node, score)
-    childNodes = generateOrderedChildPositions(node)
+    position = Position.fromLists(heights, pieces)
+    for move in (ordering or HEIGHT_ORDERING).order(position, 0, None):
+        position.applyMove(move)
+        newHeights, newPieces = position.toLists()
+        position.undoMove(move)
+        yield newHeights, newPieces, -color
+
+# The kinds of score stored in a transposition table entry.
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+class TranspositionTable(object):
+    """A fixed size table of search results indexed by Zobrist hash.
+
+    Each slot holds (hash, depth, score, bound, bestMove, generation). With the 'depth' replacement
+    policy a slot is only overwritten by a search at least as deep, unless its entry is from an
+    earlier call to newSearch; with 'always' the newest result wins."""
+
+    def __init__(self, size=1 << 18, replacement='depth'):
+        if replacement not in ('depth', 'always'):
+            raise ValueError('Unknown replacement policy: {}'.format(replacement))
+        self.size = size
+        self.replacement = replacement
+        self.slots = [None] * size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def newSearch(self):
+        """Mark existing entries as stale so that they can be replaced by the next search."""
+        self.generation += 1
+
+    def probe(self, key):
+        """Return the entry for a hash, or None if it isn't in the table."""
+        entry = self.peek(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def peek(self, key):
+        """Look a hash up like probe, but without counting a hit or miss, for bookkeeping that isn't
+        part of a search."""
+        entry = self.slots[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, bound, bestMove):
+        index = key % self.size
+        entry = self.slots[index]
+        if (entry is None or self.replacement == 'always' or entry[0] == key or depth >= entry[1]
+                or entry[5] != self.generation):
+            self.slots[index] = (key, depth, score, bound, bestMove, self.generation)
+
+    def clear(self):
+        self.slots = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+# The table used by the negamax players unless they are given one.
+TRANSPOSITION_TABLE = TranspositionTable()
+
+def probeTable(table, position, depth, alpha, beta):
+    """Look a position up in a table. Return (score, bestMove), where score is None unless the stored
+    result is deep enough to end the search of this position.
+
+    Entries are keyed by Position.canonicalHash, so a rotation or reflection of a position that has
+    been searched finds its result, and their best moves are stored as played in the canonical image."""
+    key, symmetry = position.canonicalHash()
+    entry = table.probe(key)
+    if entry is None:
+        return None, None
+    bestMove = entry[4]
+    if bestMove is not None and symmetry != 0:
+        bestMove = transformSquareMove(bestMove, SYMMETRY_INVERSES[symmetry])
+    if entry[1] >= depth:
+        score, bound = entry[2], entry[3]
+        if bound == EXACT or (bound == LOWER_BOUND and score >= beta) or (bound == UPPER_BOUND and score <= alpha):
+            return score, bestMove
+    return None, bestMove
+
+def storeResult(table, position, depth, value, alpha, beta, bestMove):
+    """Store a search result, where alpha and beta are the window the position was searched with."""
+    if value <= alpha:
+        bound = UPPER_BOUND
+    elif value >= beta:
+        bound = LOWER_BOUND
+    else:
+        bound = EXACT
+    storeEntry(table, position, depth, value, bound, bestMove)
+
+def storeEntry(table, position, depth, value, bound, bestMove):
+    """Store a score and bound for a position under its canonical hash."""
+    key, symmetry = position.canonicalHash()
+    if bestMove is not None and symmetry != 0:
+        bestMove = transformSquareMove(bestMove, symmetry)
+    table.store(key, depth, value, bound, bestMove)
+
+### Evaluation Cache ###
+
+class EvaluationCache(object):
+    """Search results kept in a SQLite database, so that they outlive the process that found them.
+
+    Entries are (depth, score, bound, bestMove) by canonical hash, as in a TranspositionTable. Stores
+    are held back until flush writes them in one transaction, keeping the deeper of two results for
+    the same position. Once the database holds more than maxEntries the shallowest entries are
+    evicted, least recently used first. Any number of processes can share a file: each opens its own
+    connection, and SQLite's write-ahead log lets them read while one of them writes."""
+
+    def __init__(self, path, maxEntries=1 << 20, minDepth=2):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.minDepth = minDepth
+        self.pending = {}
+        self.used = set()
+        self.writesSinceCheck = maxEntries
+        self.connection = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def connect(self):
+        """Return this process's connection, opening it (and creating the table) if need be."""
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.pid = os.getpid()
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS evaluations (key INTEGER PRIMARY KEY, depth INTEGER, '
+                                        'score INTEGER, bound INTEGER, bestMove INTEGER, used INTEGER)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS eviction ON evaluations (depth, used)')
+        return self.connection
+
+    def lookup(self, keys):
+        """Return a dictionary from those of the keys in the cache to (depth, score, bound, bestMove)."""
+        keys = set(keys)
+        entries = {}
+        keyList = list(keys)
+        for start in range(0, len(keyList), 500):
+            batch = keyList[start:start + 500]
+            rows = self.connect().execute('SELECT key, depth, score, bound, bestMove FROM evaluations WHERE key IN ({})'
+                                          .format(','.join('?' * len(batch))), [_signedKey(key) for key in batch])
+            for key, depth, score, bound, bestMove in rows:
+                entries[key % (1 << 64)] = (depth, score, bound, _decodeCachedMove(bestMove))
+        for key in keys & set(self.pending):
+            if key not in entries or self.pending[key][0] >= entries[key][0]:
+                entries[key] = self.pending[key]
+        self.used.update(entries)
+        return entries
+
+    def store(self, key, depth, score, bound, bestMove):
+        if depth < self.minDepth:
+            return
+        entry = self.pending.get(key)
+        if entry is None or depth >= entry[0]:
+            self.pending[key] = (depth, score, bound, bestMove)
+
+    def flush(self):
+        """Write the pending stores and the times entries were used, evicting entries if over the cap."""
+        if not self.pending and not self.used:
+            return
+        now = int(time.time() * 1000)
+        rows = [(_signedKey(key), depth, score, bound, _encodeCachedMove(bestMove), now)
+                for key, (depth, score, bound, bestMove) in self.pending.items()]
+        connection = self.connect()
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO evaluations VALUES (?, ?, ?, ?, ?, ?)', rows)
+            connection.executemany('UPDATE evaluations SET depth = ?, score = ?, bound = ?, bestMove = ?, used = ? '
+                                   'WHERE key = ? AND depth <= ?',
+                                   [row[1:] + (row[0], row[1]) for row in rows])
+            connection.executemany('UPDATE evaluations SET used = ? WHERE key = ?',
+                                   [(now, _signedKey(key)) for key in self.used])
+            # Counting the rows means reading the whole index, so only do it once enough has been written.
+            self.writesSinceCheck += len(rows)
+            if self.writesSinceCheck >= self.maxEntries // 16:
+                self.writesSinceCheck = 0
+                excess = connection.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0] - self.maxEntries
+                if excess > 0:
+                    connection.execute('DELETE FROM evaluations WHERE key IN '
+                                       '(SELECT key FROM evaluations ORDER BY depth, used LIMIT ?)', (excess,))
+        self.pending = {}
+        self.used = set()
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM evaluations').fetchone()[0] + len(self.pending)
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def _signedKey(key):
+    """SQLite integers are signed 64 bit, so hashes with the top bit set are stored as negative numbers."""
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def _encodeCachedMove(move):
+    if move is None:
+        return None
+    fromSquare, toSquare, buildSquare = move
+    return (fromSquare * 25 + toSquare) * 26 + (25 if buildSquare is None else buildSquare)
+
+def _decodeCachedMove(code):
+    if code is None:
+        return None
+    code, buildSquare = divmod(code, 26)
+    return code // 25, code % 25, None if buildSquare == 25 else buildSquare
+
+# Caches that have been opened in this process, by path.
+_evaluationCaches = {}
+
+def openEvaluationCache(path):
+    """Return the EvaluationCache for a path, or None if path is None."""
+    if path is None:
+        return None
+    if path not in _evaluationCaches:
+        _evaluationCaches[path] = EvaluationCache(path)
+    return _evaluationCaches[path]
+
+def childKeys(position, moves):
+    """Return the canonical hashes of the positions after each move."""
+    keys = []
+    for move in moves:
+        position.applyMove(move)
+        keys.append(position.canonicalHash()[0])
+        position.undoMove(move)
+    return keys
+
+def warmStartTable(table, cache, keys):
+    """Copy whatever the cache knows about the given positions into a transposition table."""
+    for key, (depth, score, bound, bestMove) in cache.lookup(keys).items():
+        entry = table.peek(key)
+        if entry is None or entry[1] < depth:
+            table.store(key, depth, score, bound, bestMove)
+
+def saveTableEntries(table, cache, keys):
+    """Write the table's entries for the given positions to the cache."""
+    for key in keys:
+        entry = table.peek(key)
+        if entry is not None:
+            cache.store(*entry[:5])
+    cache.flush()
+
+class HeightOrdering(object):
+    """A move ordering strategy: the hint move first, then the moves that climb highest.
+
+    A strategy's order method yields the moves to search at a node with the given remaining depth. It
+    works in stages, so the moves the search tries first are checked for legality on their own and
+    the rest are only generated and sorted if the search gets past them. recordCutoff is told about
+    each move that caused a beta cutoff, so that a strategy can learn from the search. newSearch is
+    called before each search for a move."""
+
+    def newSearch(self):
+        pass
+
+    def order(self, position, depth, hintMove):
+        if hintMove is not None and position.isLegalMove(hintMove):
+            yield hintMove
+        for move in orderedMoves(position):
+            if move != hintMove:
+                yield move
+
+    def recordCutoff(self, position, move, depth):
+        pass
+
+# History scores are capped below this, so that they only order moves that climb to the same height.
+HISTORY_LIMIT = 1 << 20
+
+class KillerHistoryOrdering(HeightOrdering):
+    """Order moves by the hint move, then winning moves, then the killer moves for the depth (the last
+    moves to cause a cutoff at that depth), then by height climbed and lastly by the history table,
+    which adds depth squared for a move each time it causes a cutoff."""
+
+    def __init__(self, killersPerDepth=2):
+        self.killersPerDepth = killersPerDepth
+        self.killers = defaultdict(list)
+        self.history = defaultdict(int)
+
+    def newSearch(self):
+        self.killers.clear()
+        # Age the history rather than dropping it, as the same moves tend to stay good.
+        for move in list(self.history):
+            self.history[move] //= 2
+            if self.history[move] == 0:
+                del self.history[move]
+
+    def order(self, position, depth, hintMove):
+        searched = []
+        if hintMove is not None and position.isLegalMove(hintMove):
+            searched.append(hintMove)
+            yield hintMove
+        winningMove = position.winningMove()
+        if winningMove is not None and winningMove not in searched:
+            searched.append(winningMove)
+            yield winningMove
+        for killer in self.killers.get(depth, ()):
+            if killer not in searched and position.isLegalMove(killer):
+                searched.append(killer)
+                yield killer
+        heights = position.heights
+        history = self.history
+        # The sort is stable, so equal moves keep the order they were generated in.
+        for move in sorted(position.generateMoves(), key=lambda move: heights[move[1]] * HISTORY_LIMIT + history.get(move, 0),
+                           reverse=True):
+            if move not in searched:
+                yield move
+
+    def recordCutoff(self, position, move, depth):
+        killers = self.killers[depth]
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[self.killersPerDepth:]
+        self.history[move] = min(self.history[move] + depth * depth, HISTORY_LIMIT - 1)
+
+HEIGHT_ORDERING = HeightOrdering()
+# The ordering used by the negamax players unless they are given one.
+MOVE_ORDERING = KillerHistoryOrdering()
+
+class OutOfTime(Exception):
+    """Raised inside a search when its deadline has passed."""
+    pass
+
+class SearchStats(object):
+    """Statistics about a search, filled in when one is passed to it.
+
+    nodesByDepth counts the nodes visited by remaining depth. Expanded nodes are those whose children
+    were searched, and a cutoff is an expanded node that stopped early because alpha reached beta.
+    researches counts the moves that beat a null window search and had to be searched again.
+    transpositions counts nodes that had already been visited through a different move order."""
+
+    def __init__(self):
+        self.nodesByDepth = Counter()
+        self.expandedNodes = 0
+        self.childrenSearched = 0
+        self.cutoffs = 0
+        self.firstMoveCutoffs = 0
+        self.researches = 0
+        self.tableCutoffs = 0
+        self.tablebaseHits = 0
+        self.transpositions = 0
+        self.generationSeconds = 0.0
+        self.evaluationSeconds = 0.0
+        self.elapsedSeconds = 0.0
+        self.completedDepth = None
+        self.score = None
+        self.seenHashes = set()
+
+    def visit(self, position, depth):
+        self.nodesByDepth[depth] += 1
+        if position.hash in self.seenHashes:
+            self.transpositions += 1
+        else:
+            self.seenHashes.add(position.hash)
+
+    def nodes(self):
+        return sum(self.nodesByDepth.values())
+
+    def branchingFactor(self):
+        """Return the average number of children searched per expanded node."""
+        return self.childrenSearched / float(self.expandedNodes) if self.expandedNodes else 0.0
+
+    def cutoffRate(self):
+        return self.cutoffs / float(self.expandedNodes) if self.expandedNodes else 0.0
+
+    def firstMoveCutoffRate(self):
+        """Return the fraction of cutoffs caused by the first move searched."""
+        return self.firstMoveCutoffs / float(self.cutoffs) if self.cutoffs else 0.0
+
+    def merge(self, other):
+        """Add the counts from another search, e.g. one run in a worker process."""
+        self.nodesByDepth.update(other.nodesByDepth)
+        for name in ['expandedNodes', 'childrenSearched', 'cutoffs', 'firstMoveCutoffs', 'researches', 'tableCutoffs',
+                     'tablebaseHits', 'transpositions', 'generationSeconds', 'evaluationSeconds']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.transpositions += len(self.seenHashes & other.seenHashes)
+        self.seenHashes |= other.seenHashes
+
+    def summary(self):
+        """Return the statistics as a dictionary."""
+        return {'nodes': self.nodes(), 'nodesByDepth': dict(self.nodesByDepth), 'branchingFactor': self.branchingFactor(),
+                'cutoffRate': self.cutoffRate(), 'firstMoveCutoffRate': self.firstMoveCutoffRate(), 'researches': self.researches,
+                'tableCutoffs': self.tableCutoffs, 'tablebaseHits': self.tablebaseHits,
+                'transpositions': self.transpositions,
+                'generationSeconds': self.generationSeconds, 'evaluationSeconds': self.evaluationSeconds,
+                'elapsedSeconds': self.elapsedSeconds, 'completedDepth': self.completedDepth, 'score': self.score}
+
+def searchNegamax(position, depth, alpha, beta, table=None, deadline=None, stats=None, ordering=None):
+    """Return the negamax score of a position for the player to move, searching it in place.
+
+    This is a principal variation search: after the first move, each move is searched with a null
+    window to show that it is no better, and only searched again with the full window if it is. The
+    moves are ordered by ordering (see HeightOrdering), by default the highest climbs first.
+
+    If a deadline (a time.time() value, or a PonderDeadline) is given then OutOfTime is raised once
+    it has passed. The position is left part way through the search in that case, and nothing
+    unfinished is stored. If a SearchStats is given then it is updated as the search goes."""
+    if deadline is not None and time.time() > deadline:
+        raise OutOfTime()
+    if stats is not None:
+        stats.visit(position, depth)
+    if position.lastMoveWon():
+        return -1000
+    if ENDGAME_TABLEBASE is not None and ENDGAME_TABLEBASE.covers(position):
+        result = ENDGAME_TABLEBASE.probe(position)
+        if result is not None:
+            if stats is not None:
+                stats.tablebaseHits += 1
+            return 1000 if result[0] else -1000
+    if depth == 0:
+        if stats is not None:
+            startTime = time.time()
+            score = position.evaluate()
+            stats.evaluationSeconds += time.time() - startTime
+            return score
+        return position.evaluate()
+    if position.hasWinningMove():
+        # Nothing scores better than winning, so there is no need to look at the other moves.
+        return 1000
+    hintMove = None
+    if table is not None:
+        score, hintMove = probeTable(table, position, depth, alpha, beta)
+        if score is not None:
+            if stats is not None:
+                stats.tableCutoffs += 1
+            return score
+    if depth == 1 and BATCH_FRONTIER and numpy is not None:
+        # Score the whole frontier in one vectorised pass rather than leaf by leaf.
+        value, bestMove = searchFrontier(position, stats)
+        if table is not None:
+            storeEntry(table, position, depth, value, EXACT, bestMove)
+        return value
+    originalAlpha = alpha
     value = -1000
-    for child in childNodes:
-        value = max(value, -negamax(child, depth - 1, -beta, -alpha, -color))
+    bestMove = None
+    if ordering is None:
+        ordering = HEIGHT_ORDERING
+    moves = ordering.order(position, depth, hintMove)
+    if stats is not None:
+        stats.expandedNodes += 1
+    moveIndex = 0
+    while True:
+        # The moves are generated lazily, so a cutoff saves generating and sorting the rest.
+        if stats is not None:
+            startTime = time.time()
+            move = next(moves, None)
+            stats.generationSeconds += time.time() - startTime
+        else:
+            move = next(moves, None)
+        if move is None:
+            break
+        position.applyMove(move)
+        if moveIndex == 0:
+            score = -searchNegamax(position, depth - 1, -beta, -alpha, table, deadline, stats, ordering)
+        else:
+            # Scores are whole numbers, so a window of width one tests whether the move beats alpha.
+            score = -searchNegamax(position, depth - 1, -alpha - 1, -alpha, table, deadline, stats, ordering)
+            if alpha < score < beta:
+                if stats is not None:
+                    stats.researches += 1
+                score = -searchNegamax(position, depth - 1, -beta, -alpha, table, deadline, stats, ordering)
+        position.undoMove(move)
+        if bestMove is None or score > value:
+            value = score
+            bestMove = move
         alpha = max(alpha, value)
         if alpha >= beta:
+            ordering.recordCutoff(position, move, depth)
+            if stats is not None:
+                stats.cutoffs += 1
+                if moveIndex == 0:
+                    stats.firstMoveCutoffs += 1
+            moveIndex += 1
             break
+        moveIndex += 1
+    if stats is not None:
+        stats.childrenSearched += moveIndex
+    if table is not None:
+        storeResult(table, position, depth, value, originalAlpha, beta, bestMove)
     return value
 
-def negamaxPlayer(heights, pieces, setUp, startDepth=3):
-    # node is (heights, pieces, color)
-    
+def negamax(node, depth, alpha, beta, color, table=None, ordering=None):
+    """Return the negamax score of a (heights, pieces, color) node or a Position."""
+    if not isinstance(node, Position):
+        node = Position.fromLists(node[0], node[1])
+    return searchNegamax(node, depth, alpha, beta, table, None, None, ordering)
+
+def searchRootMove(position, move, depth, bestScore, table=None, stats=None, ordering=None):
+    """Return the score of a root move. Scores are whole numbers, so the search only needs to be exact
+    for moves that score at least bestScore - any lower score is returned as an upper bound."""
+    position.applyMove(move)
+    score = -searchNegamax(position, depth, -1000, 1 - bestScore, table, None, stats, ordering)
+    position.undoMove(move)
+    return score
+
+# The shared best root score in each parallel root search worker, and the id of the search it was last used for.
+_rootWorkerState = {}
+
+def _initRootWorker(sharedBestScore):
+    _rootWorkerState['bestScore'] = sharedBestScore
+    _rootWorkerState['searchId'] = None
+
+def _searchRootMoveInWorker(task):
+    searchId, heights, pieces, move, depth, collectStats = task
+    sharedBestScore = _rootWorkerState['bestScore']
+    if _rootWorkerState['searchId'] != searchId:
+        _rootWorkerState['searchId'] = searchId
+        TRANSPOSITION_TABLE.newSearch()
+        MOVE_ORDERING.newSearch()
+    stats = SearchStats() if collectStats else None
+    score = searchRootMove(Position.fromLists(heights, pieces), move, depth, sharedBestScore.value, TRANSPOSITION_TABLE, stats,
+                           MOVE_ORDERING)
+    with sharedBestScore.get_lock():
+        if score > sharedBestScore.value:
+            sharedBestScore.value = score
+    return move, score, stats
+
+# Worker pools for parallel root search, kept between moves, keyed by the number of processes.
+_rootPools = {}
+
+def _getRootPool(processes):
+    if processes not in _rootPools:
+        sharedBestScore = multiprocessing.Value('i', -1000)
+        pool = multiprocessing.Pool(processes, initializer=_initRootWorker, initargs=(sharedBestScore,))
+        _rootPools[processes] = (pool, sharedBestScore)
+    return _rootPools[processes]
+
+def parallelRootScores(heights, pieces, moves, depth, processes, stats=None):
+    """Score root moves in a pool of processes. As each worker finishes a move it raises the shared
+    best score, which later moves are searched against."""
+    pool, sharedBestScore = _getRootPool(processes)
+    sharedBestScore.value = -1000
+    searchId = (time.time(), id(moves))
+    tasks = [(searchId, heights, pieces, move, depth, stats is not None) for move in moves]
+    scores = {}
+    for move, score, moveStats in pool.imap_unordered(_searchRootMoveInWorker, tasks):
+        scores[move] = score
+        if stats is not None:
+            stats.merge(moveStats)
+    return scores
+
+def negamaxPlayer(heights, pieces, setUp, startDepth=4, table=TRANSPOSITION_TABLE, processes=1, stats=None,
+                  openingBook=OPENING_BOOK_PATH, ordering=MOVE_ORDERING, evaluationCache=EVALUATION_CACHE_PATH):
+    """A negamax player. With processes greater than one the root moves are searched in parallel, and
+    the move chosen is the same as the one the sequential search picks. If a SearchStats is given then
+    it is filled in (see withSearchStats). Positions in the opening book (a path, or None to search
+    everything) are played from it. ordering is the move ordering strategy used below the root; the
+    parallel workers always use their own MOVE_ORDERING. A sequential search with a table starts from
+    the results for the root's children in the evaluation cache (a path, or None), and adds its own."""
+    startTime = time.time()
+    bookMove = openingBookMove(heights, pieces, setUp, openingBook)
+    if bookMove is not None:
+        return bookMove
     # AI entry point.
     if setUp:
         return tryToClimb(heights, pieces, setUp)
     # Check for instant win.
     winningMove = getWinningMove(heights, pieces)
     if winningMove != None:
+        if stats is not None:
+            stats.completedDepth, stats.score = 0, 1000
         return winningMove
+    if table is not None:
+        table.newSearch()
+    ordering.newSearch()
     # Check value of all moves.
     bestScore = -1000
     bestMove = defensivePlayer(heights, pieces, setUp)
-    for pieceName in PIECES:
-        x, y = findPiecePos(pieces, pieceName)
-        moveDirs = validMoves(heights, pieces, x, y)
-        for moveDir in moveDirs:
-            newPieces = moveThenSwapPieces(pieces, x, y, moveDir)
-            buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-            for buildDir in buildDirs:
-                newHeights = deepcopy(heights)
-                newHeights[y + moveDir[1] + buildDir[1]][x + moveDir[0] + buildDir[0]] += 1
-                rootNode = (newHeights, newPieces, -1)
-                score = -negamax(rootNode, startDepth, -1000, 1000, 1)
-                if score > bestScore:
-                    bestScore = score
-                    bestMove = (pieceName, moveDir, buildDir)
-                    if bestScore >= 1000:
-                        return bestMove
+    position = Position.fromLists(heights, pieces)
+    # Moves that mirror an earlier move in a symmetric position score the same, so skip them.
+    moves = position.uniqueMoves(position.generateMoves())
+    cache = openEvaluationCache(evaluationCache) if table is not None and processes == 1 else None
+    if cache is not None:
+        keys = childKeys(position, moves)
+        warmStartTable(table, cache, keys)
+    if processes > 1:
+        # Hand out the most promising moves first so that the shared best score rises quickly.
+        uniqueMoves = set(moves)
+        scores = parallelRootScores(heights, pieces, [move for move in orderedMoves(position) if move in uniqueMoves],
+                                    startDepth, processes, stats)
+    for move in moves:
+        if processes > 1:
+            score = scores[move]
+        else:
+            score = searchRootMove(position, move, startDepth, bestScore, table, stats, ordering)
+        if score > bestScore:
+            bestScore = score
+            bestMove = position.describeMove(move)
+            if bestScore >= 1000:
+                break
+    if cache is not None:
+        saveTableEntries(table, cache, keys)
+    if stats is not None:
+        stats.completedDepth = startDepth
+        stats.score = bestScore
+        stats.elapsedSeconds = time.time() - startTime
     return bestMove
 
+def withSearchStats(player, heights, pieces, **options):
+    """Ask a search player for a move, returning (move, stats) where stats is a SearchStats."""
+    stats = SearchStats()
+    move = player(heights, pieces, False, stats=stats, **options)
+    return move, stats
+
+### Position Analysis ###
+
+def analysePosition(heights, pieces, depth=4, timeBudgetMs=None):
+    """Search a position for the player to move and return (bestMove, score, depth, nodes).
+
+    The search is negamaxPlayer to the given depth, or timeLimitedNegamaxPlayer if timeBudgetMs is
+    given, in which case depth is the deepest iteration finished. The opening book isn't used, so that
+    every position gets a score. The searches share TRANSPOSITION_TABLE, so analysing related positions
+    one after another (such as the positions of a game) reuses earlier work."""
+    if timeBudgetMs is None:
+        move, stats = withSearchStats(negamaxPlayer, heights, pieces, startDepth=depth, openingBook=None)
+    else:
+        move, stats = withSearchStats(timeLimitedNegamaxPlayer, heights, pieces, timeBudgetMs=timeBudgetMs,
+                                      maxDepth=depth, openingBook=None)
+    return move, stats.score, stats.completedDepth, stats.nodes()
+
+def _analysePositionInWorker(task):
+    heights, pieces, depth, timeBudgetMs = task
+    return analysePosition(heights, pieces, depth, timeBudgetMs)
+
+def analysePositions(positions, depth=4, timeBudgetMs=None, processes=1, maxInFlight=None):
+    """Yield analysePosition's (bestMove, score, depth, nodes) for each (heights, pieces) in positions,
+    in the same order.
+
+    positions can be any iterable, and is only read as far as needed: with processes greater than one
+    the positions are searched in a pool, with at most maxInFlight (by default four per process) sent
+    out and not yet yielded. Each worker keeps its transposition table from one position to the next."""
+    if processes <= 1:
+        for heights, pieces in positions:
+            yield analysePosition(heights, pieces, depth, timeBudgetMs)
+        return
+    if maxInFlight is None:
+        maxInFlight = 4 * processes
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for heights, pieces in positions:
+            pending.append(pool.apply_async(_analysePositionInWorker, ((heights, pieces, depth, timeBudgetMs),)))
+            if len(pending) >= maxInFlight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
 ### Start Time Limited Negamax ###
 
-def timeLimitedNegamax(node, depth, alpha, beta, color):
-    startTime = time.time()
-    heights, pieces, color = node
-    score = scoreIfEndGame(node)
-    if depth == 0 or score != 0:
-        return color * heuristic(node, score)
-    childNodes = generateOrderedChildPositions(node)
-    value = -1000
-    for child in childNodes:
-        value = max(value, -timeLimitedNegamax(child, depth - 1, -beta, -alpha, -color))
-        alpha = max(alpha, value)
-        if alpha >= beta:
-            break
-        if time.time() > startTime + (10 ** depth) * 0.000008:
-            break
-    return value
+def timeLimitedNegamax(node, depth, alpha, beta, color, table=None, deadline=None):
+    """Return the negamax score of a (heights, pieces, color) node or a Position, raising OutOfTime
+    if the deadline passes first."""
+    if not isinstance(node, Position):
+        node = Position.fromLists(node[0], node[1])
+    return searchNegamax(node, depth, alpha, beta, table, deadline)
 
-def timeLimitedNegamaxPlayer(heights, pieces, setUp, startDepth=4):
-    # node is (heights, pieces, color)
-    
+def timeLimitedNegamaxPlayer(heights, pieces, setUp, timeBudgetMs=1000, maxDepth=20, table=TRANSPOSITION_TABLE, stats=None,
+                             openingBook=OPENING_BOOK_PATH, ordering=MOVE_ORDERING, evaluationCache=EVALUATION_CACHE_PATH):
+    """A negamax player that searches one ply deeper at a time until its time budget runs out.
+
+    The move from the deepest finished iteration is played. Each iteration searches the previous
+    iteration's best moves first, and the table passes on the rest of the principal variation. If a
+    SearchStats is given then it is filled in (see withSearchStats). Positions in the opening book are
+    played from it, moves are ordered by ordering, and the evaluation cache is used as in negamaxPlayer."""
+    bookMove = openingBookMove(heights, pieces, setUp, openingBook)
+    if bookMove is not None:
+        return bookMove
     # AI entry point.
     if setUp:
         return tryToClimb(heights, pieces, setUp)
+    startTime = time.time()
+    deadline = startTime + timeBudgetMs / 1000.0
     # Check for instant win.
     winningMove = getWinningMove(heights, pieces)
     if winningMove != None:
+        if stats is not None:
+            stats.completedDepth, stats.score = 0, 1000
         return winningMove
-    # Check value of all moves.
-    bestScore = -1000
-    bestMove = defensivePlayer(heights, pieces, setUp)
-    for pieceName in PIECES:
-        x, y = findPiecePos(pieces, pieceName)
-        moveDirs = validMoves(heights, pieces, x, y)
-        for moveDir in moveDirs:
-            newPieces = moveThenSwapPieces(pieces, x, y, moveDir)
-            buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-            for buildDir in buildDirs:
-                newHeights = deepcopy(heights)
-                newHeights[y + moveDir[1] + buildDir[1]][x + moveDir[0] + buildDir[0]] += 1
-                rootNode = (newHeights, newPieces, -1)
-                score = -timeLimitedNegamax(rootNode, startDepth, -1000, 1000, 1)
-                if score > bestScore:
+    if table is not None:
+        table.newSearch()
+    ordering.newSearch()
+    position = Position.fromLists(heights, pieces)
+    rootMoves = position.uniqueMoves(orderedMoves(position))
+    if len(rootMoves) == 0:
+        return defensivePlayer(heights, pieces, setUp)
+    # Describe the moves up front, since a search that runs out of time leaves the position mid-search.
+    descriptions = dict((move, position.describeMove(move)) for move in rootMoves)
+    bestMove = rootMoves[0]
+    cache = openEvaluationCache(evaluationCache) if table is not None else None
+    if cache is not None:
+        keys = childKeys(position, rootMoves)
+        warmStartTable(table, cache, keys)
+    try:
+        for depth in range(maxDepth + 1):
+            bestScore = -1000
+            iterationBestMove = None
+            rootScores = {}
+            for move in rootMoves:
+                position.applyMove(move)
+                # Only a score better than the best so far matters, so the others can fail low.
+                score = -searchNegamax(position, depth, -1000, -bestScore, table, deadline, stats, ordering)
+                position.undoMove(move)
+                rootScores[move] = score
+                if iterationBestMove is None or score > bestScore:
                     bestScore = score
-                    bestMove = (pieceName, moveDir, buildDir)
+                    iterationBestMove = move
                     if bestScore >= 1000:
-                        return bestMove
-    return bestMove
+                        break
+            bestMove = iterationBestMove
+            if stats is not None:
+                stats.completedDepth = depth
+                stats.score = bestScore
+            if bestScore >= 1000 or bestScore <= -1000:
+                # The game is decided, so searching deeper won't change anything.
+                break
+            # Search the best moves of this iteration first in the next one.
+            rootMoves.sort(key=lambda move: -rootScores[move])
+            rootMoves.remove(bestMove)
+            rootMoves.insert(0, bestMove)
+    except OutOfTime:
+        pass
+    if cache is not None:
+        saveTableEntries(table, cache, keys)
+    if stats is not None:
+        stats.elapsedSeconds = time.time() - startTime
+    return descriptions[bestMove]
 
 ### End Time Limited Negamax ###
 
+### Pondering ###
 
-def montePlayer(heights, pieces, setUp):
-    def moveThenSwapPieces(pieces, pieceX, pieceY, moveDir):
-        pieceNameMap = {PIECES[0]: [OPPONENT], PIECES[1]: [OPPONENT], OPPONENT: list(PIECES)}
-        newPieces = [[EMPTY] * 5 for i in range(5)]
-        for y in range(5):
-            for x in range(5):
-                if x != pieceX or y != pieceY:
-                    if pieces[y][x] != EMPTY:
-                        newPieces[y][x] = pieceNameMap[pieces[y][x]].pop()
-        newPieces[pieceY + moveDir[1]][pieceX + moveDir[0]] = OPPONENT
-        return newPieces
-    
-    def simulate(heights, pieces, simulations):
+class PonderDeadline(object):
+    """A deadline for searchNegamax that passes when stop is called rather than at a set time."""
+
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    # searchNegamax checks time.time() > deadline, which Python turns into deadline.__lt__(time.time()).
+    def __lt__(self, now):
+        return self.stopped
+
+# The deepest Ponderer searches. Each depth takes several times as long as the last, and depth 4
+# already takes half a minute in the middle game.
+PONDER_MAX_DEPTH = 5
+
+class Ponderer(object):
+    """Searches on the opponent's time: after a player moves, start searches the opponent's likely
+    replies in a background thread, filling the transposition table the player searches with, until
+    stop is called when the player is next asked for a move or the game ends, the replies are all
+    decided or maxDepth is reached.
+
+    The reply the table predicts is searched first, then the others that climb highest, up to
+    maxReplies, one ply deeper at a time. completedDepth is the deepest search a player can then make
+    of one of them almost for free. If the opponent plays something else, the player's newSearch
+    marks the entries as stale and they are replaced as the search goes.
+
+    As the thread holds the interpreter while it searches, pondering only helps against an opponent
+    that thinks elsewhere, such as humanPlayer or a remote engine."""
+
+    def __init__(self, table=TRANSPOSITION_TABLE, ordering=MOVE_ORDERING, maxReplies=4, maxDepth=PONDER_MAX_DEPTH):
+        self.table = table
+        self.ordering = ordering
+        self.maxReplies = maxReplies
+        self.maxDepth = maxDepth
+        self.thread = None
+        self.deadline = None
+        self.replies = []
+        self.completedDepth = None
+
+    def start(self, heights, pieces, move):
+        """Start pondering the replies to a (pieceName, moveDir, buildDir) move made from a position."""
+        self.stop()
+        position = Position.fromLists(heights, pieces)
+        position.applyMove(moveFromDescription(position, move))
+        if position.lastMoveWon():
+            return
+        predicted = probeTable(self.table, position, 0, -1000, 1000)[1]
+        replies = [] if predicted is None or not position.isLegalMove(predicted) else [predicted]
+        replies += [reply for reply in position.uniqueMoves(orderedMoves(position)) if reply != predicted]
+        self.replies = replies[:self.maxReplies]
+        self.completedDepth = None
+        self.deadline = PonderDeadline()
+        self.thread = threading.Thread(target=self.ponder, args=(position, self.replies, self.deadline), name='ponderer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ponder(self, position, replies, deadline):
+        try:
+            for depth in range(1, self.maxDepth + 1):
+                decided = True
+                for reply in replies:
+                    position.applyMove(reply)
+                    # Search each of the player's moves with the full window, so that the player's own
+                    # searches of them, whatever their windows, stop at the table.
+                    for move in position.uniqueMoves(position.generateMoves()):
+                        position.applyMove(move)
+                        score = searchNegamax(position, depth, -1000, 1000, self.table, deadline, None, self.ordering)
+                        decided = decided and abs(score) >= 1000
+                        position.undoMove(move)
+                    position.undoMove(reply)
+                self.completedDepth = depth
+                # Searching deeper can't change a won or lost score.
+                if decided:
+                    break
+        except OutOfTime:
+            pass
+
+    def stop(self):
+        """Stop pondering, waiting for the search to finish with the table."""
+        if self.thread is not None:
+            self.deadline.stop()
+            self.thread.join()
+            self.thread = None
+
+def ponderingPlayer(player, table=TRANSPOSITION_TABLE, ordering=MOVE_ORDERING, maxReplies=4):
+    """Return a version of a search player that ponders (see Ponderer) after each move. The player
+    must search with the given table and ordering, as negamaxPlayer and timeLimitedNegamaxPlayer do
+    by default. The Ponderer is the returned player's ponderer attribute, and its endGame attribute
+    stops pondering once the game is over."""
+    ponderer = Ponderer(table, ordering, maxReplies)
+
+    def pondering(heights, pieces, setUp, **options):
+        ponderer.stop()
+        move = player(heights, pieces, setUp, **options)
+        if not setUp and move[0] is not None:
+            ponderer.start(heights, pieces, move)
+        return move
+
+    pondering.__name__ = 'pondering ' + player.__name__
+    pondering.ponderer = ponderer
+    pondering.endGame = ponderer.stop
+    return pondering
+
+
+# The number of rollouts montePlayer plays after each of its moves.
+MONTE_CARLO_ROLLOUTS = 30
+
+def montePlayer(heights, pieces, setUp, rollouts=MONTE_CARLO_ROLLOUTS):
+    """A player that plays each move out a number of times with defensiveRolloutPolicy and picks the
+    move whose rollouts score best, a win or loss counting for more the sooner it comes."""
+    def simulate(position, simulations):
         score = 0
         for i in range(simulations):
-            newHeights = deepcopy(heights)
-            newPieces = deepcopy(pieces)
-            turnNumber = 0
-            finished = False
-            while not finished:
-                for playerIndex in range(2):
-                    pieceName, moveDir, buildDir = defensivePlayer(newHeights, newPieces, False)
-                    if pieceName == None:
-                        score -= (1 - 2 * playerIndex) / (turnNumber + 1.0)
-                        finished = True
-                        break
-                    x, y = findPiecePos(newPieces, pieceName)
-                    newPieces[y][x] = EMPTY
-                    newPieces[y + moveDir[1]][x + moveDir[0]] = pieceName
-                    if newHeights[y][x] == MAX_HEIGHT - 1:
-                        score -= (1 - 2 * playerIndex) / (turnNumber + 1.0)
-                        finished = True
-                        break
-                    newHeights[y + moveDir[1] + buildDir[1]][x + moveDir[0] + buildDir[0]] += 1
-                    newPieces = swapPieces(newPieces)
-                    turnNumber += 1
+            winner, played = defensiveRollout(position)
+            # We're player 0 in the position made from the lists.
+            score += (1 if winner == 0 else -1) / (played + 1.0)
         return score
-    
+
     if setUp:
         return tryToClimb(heights, pieces, setUp)
     # Check for instant win.
@@ -499,22 +1782,254 @@ def montePlayer(heights, pieces, setUp):
     if winningMove != None:
         return winningMove
     # Check value of all moves.
-    bestScore = -1000
-    bestMove = defensivePlayer(heights, pieces, setUp)
-    for pieceName in PIECES:
-        x, y = findPiecePos(pieces, pieceName)
-        moveDirs = validMoves(heights, pieces, x, y)
-        for moveDir in moveDirs:
-            newPieces = moveThenSwapPieces(pieces, x, y, moveDir)
-            buildDirs = validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName)
-            for buildDir in buildDirs:
-                newHeights = deepcopy(heights)
-                newHeights[y + moveDir[1] + buildDir[1]][x + moveDir[0] + buildDir[0]] += 1
-                score = simulate(newHeights, newPieces, 10)
-                if score > bestScore:
-                    bestScore = score
-                    bestMove = (pieceName, moveDir, buildDir)
-    return bestMove    
+    bestScore = None
+    bestMove = None
+    position = Position.fromLists(heights, pieces)
+    for move in position.generateMoves():
+        position.applyMove(move)
+        score = simulate(position, rollouts)
+        position.undoMove(move)
+        if bestScore is None or score > bestScore:
+            bestScore = score
+            bestMove = move
+    if bestMove is None:
+        return defensivePlayer(heights, pieces, setUp)
+    return position.describeMove(bestMove)
+
+### Start Monte Carlo Tree Search ###
+
+def randomRolloutPolicy(position):
+    """A cheap rollout policy: win at once if possible, otherwise play a random move."""
+    moves = position.generateMoves()
+    if len(moves) == 0:
+        return None
+    for move in moves:
+        if move[2] is None:
+            return move
+    return random.choice(moves)
+
+def climbingRolloutPolicy(position):
+    """A cheap rollout policy: win at once if possible, otherwise play a random move to the highest
+    square available, like tryToClimb does."""
+    heights = position.heights
+    bestMoves = []
+    bestHeight = -1
+    for move in position.generateMoves():
+        if move[2] is None:
+            return move
+        height = heights[move[1]]
+        if height > bestHeight:
+            bestHeight = height
+            bestMoves = [move]
+        elif height == bestHeight:
+            bestMoves.append(move)
+    if len(bestMoves) == 0:
+        return None
+    return random.choice(bestMoves)
+
+def _defensiveRolloutMove(heights, levels, workers, occupied, player):
+    """Choose defensiveRolloutPolicy's move straight from the board's bit masks, where occupied holds
+    the workers of both players."""
+    top = levels[MAX_HEIGHT - 1]
+    free = ~(occupied | levels[MAX_HEIGHT])
+    # The squares a worker on each height could climb to, if they're free and adjacent.
+    low = levels[0] | levels[1]
+    climbable = (low, low | levels[2], low | levels[2] | top)
+    ours = workers[player]
+    moveMasks = [NEIGHBOUR_MASKS[square] & climbable[heights[square]] & free for square in ours]
+    reachable = moveMasks[0] | moveMasks[1]
+    if reachable & top:
+        for square, moves in zip(ours, moveMasks):
+            if moves & top:
+                return square, (moves & top & -(moves & top)).bit_length() - 1, None
+    threats = 0
+    nearOpponent = 0
+    for square in workers[1 - player]:
+        if heights[square] == MAX_HEIGHT - 2:
+            threats |= NEIGHBOUR_MASKS[square] & top & free
+        nearOpponent |= NEIGHBOUR_MASKS[square]
+    # Each candidate is (fromSquare, toSquare, the squares that could be built on).
+    candidates = []
+    if threats:
+        for fromSquare, moves in zip(ours, moveMasks):
+            while moves:
+                toBit = moves & -moves
+                moves ^= toBit
+                toSquare = toBit.bit_length() - 1
+                if NEIGHBOUR_MASKS[toSquare] & threats:
+                    candidates.append((fromSquare, toSquare, NEIGHBOUR_MASKS[toSquare] & threats))
+    if candidates:
+        return _pickRolloutMove(candidates)
+    # Otherwise climb as high as possible while building away from the opponent, or failing that
+    # just climb as high as possible.
+    awayCandidates = []
+    height = MAX_HEIGHT - 2
+    while not awayCandidates and height >= 0:
+        if not reachable & levels[height]:
+            height -= 1
+            continue
+        highest = not candidates
+        for fromSquare, moves in zip(ours, moveMasks):
+            moves &= levels[height]
+            while moves:
+                toBit = moves & -moves
+                moves ^= toBit
+                toSquare = toBit.bit_length() - 1
+                builds = NEIGHBOUR_MASKS[toSquare] & (free | 1 << fromSquare)
+                if builds & ~nearOpponent:
+                    awayCandidates.append((fromSquare, toSquare, builds & ~nearOpponent))
+                elif builds and highest:
+                    candidates.append((fromSquare, toSquare, builds))
+        height -= 1
+    return _pickRolloutMove(awayCandidates or candidates)
+
+def _pickRolloutMove(candidates):
+    """Pick a (fromSquare, toSquare, buildSquare) move at random from (fromSquare, toSquare, the
+    squares that could be built on) candidates, or return None if there are none."""
+    if len(candidates) == 0:
+        return None
+    fromSquare, toSquare, builds = candidates[int(random.random() * len(candidates))]
+    # Clear a random number of the lowest bits and build on the lowest one left.
+    for i in range(int(random.random() * bin(builds).count('1'))):
+        builds &= builds - 1
+    return fromSquare, toSquare, (builds & -builds).bit_length() - 1
+
+def defensiveRolloutPolicy(position):
+    """A rollout policy that plays like defensivePlayer at a fraction of the cost: win at once if
+    possible, otherwise build where the opponent could win next turn, otherwise climb as high as
+    possible, building where the opponent can't reach if it can. Ties are broken at random."""
+    return _defensiveRolloutMove(position.heights, position.levels, position.workers,
+                                 position.occupied[0] | position.occupied[1], position.toMove)
+
+def defensiveRollout(position):
+    """Play a position out with defensiveRolloutPolicy and return (winner, the number of moves played).
+
+    This is the same game simulateGame would play, but on scratch copies of the board without the
+    hashes and scores applyMove keeps up to date, so it's several times faster. The position is left
+    unchanged."""
+    player = position.toMove
+    if position.lastMoveWon():
+        return 1 - player, 0
+    heights = list(position.heights)
+    levels = list(position.levels)
+    workers = [list(position.workers[0]), list(position.workers[1])]
+    occupied = position.occupied[0] | position.occupied[1]
+    played = 0
+    while True:
+        move = _defensiveRolloutMove(heights, levels, workers, occupied, player)
+        if move is None:
+            return 1 - player, played
+        fromSquare, toSquare, buildSquare = move
+        played += 1
+        playerWorkers = workers[player]
+        playerWorkers[playerWorkers.index(fromSquare)] = toSquare
+        occupied ^= (1 << fromSquare) | (1 << toSquare)
+        if buildSquare is None:
+            return player, played
+        height = heights[buildSquare]
+        heights[buildSquare] = height + 1
+        levels[height] ^= 1 << buildSquare
+        levels[height + 1] ^= 1 << buildSquare
+        player = 1 - player
+
+def rollout(position, rolloutPolicy):
+    """Play a position out with the rollout policy and return the winner. The position is left unchanged."""
+    winner, played = simulateGame([rolloutPolicy, rolloutPolicy], position)
+    for move in reversed(played):
+        position.undoMove(move)
+    return winner
+
+class MCTSNode(object):
+    """A node of the search tree for the position reached by playing move from the parent node.
+
+    wins counts the rollouts won by mover, the player who made move."""
+
+    def __init__(self, move, parent, mover, positionHash):
+        self.move = move
+        self.parent = parent
+        self.mover = mover
+        self.hash = positionHash
+        self.children = []
+        self.untriedMoves = None
+        self.terminal = False
+        self.visits = 0
+        self.wins = 0.0
+
+    def selectChild(self, explorationConstant):
+        """Return the child with the highest upper confidence bound."""
+        logVisits = math.log(self.visits)
+        return max(self.children, key=lambda child: child.wins / child.visits
+                   + explorationConstant * math.sqrt(logVisits / child.visits))
+
+def mctsIteration(root, position, rolloutPolicy, explorationConstant):
+    """Select a path through the tree, expand one node, run a rollout from it and back up the result."""
+    node = root
+    played = []
+    # Selection.
+    while node.untriedMoves == [] and len(node.children) > 0:
+        node = node.selectChild(explorationConstant)
+        position.applyMove(node.move)
+        played.append(node.move)
+    # Expansion.
+    if node.untriedMoves is None:
+        node.terminal = position.lastMoveWon()
+        node.untriedMoves = [] if node.terminal else position.generateMoves()
+        random.shuffle(node.untriedMoves)
+    if len(node.untriedMoves) > 0:
+        move = node.untriedMoves.pop()
+        mover = position.toMove
+        position.applyMove(move)
+        played.append(move)
+        child = MCTSNode(move, node, mover, position.hash)
+        node.children.append(child)
+        node = child
+    # Simulation.
+    if node.terminal or (node.untriedMoves == [] and len(node.children) == 0):
+        # The game is over: either the last move won or the player to move is stuck.
+        winner = 1 - position.toMove
+    else:
+        winner = rollout(position, rolloutPolicy)
+    for move in reversed(played):
+        position.undoMove(move)
+    # Backpropagation.
+    while node is not None:
+        node.visits += 1
+        if node.mover == winner:
+            node.wins += 1
+        node = node.parent
+
+# Subtrees kept from the last move made by mctsPlayer, keyed by the hash of the position they start from.
+_mctsSubtrees = {}
+
+def mctsPlayer(heights, pieces, setUp, iterations=2000, timeBudgetMs=None, rolloutPolicy=climbingRolloutPolicy, explorationConstant=1.4):
+    """A Monte Carlo tree search player using UCT.
+
+    It stops after the given number of iterations, or when timeBudgetMs is given, after that much
+    time. The subtrees below the chosen move are kept, so that if the opponent's reply was explored
+    then the next search starts from it."""
+    if setUp:
+        return tryToClimb(heights, pieces, setUp)
+    position = Position.fromLists(heights, pieces)
+    root = _mctsSubtrees.get(position.hash)
+    _mctsSubtrees.clear()
+    if root is None:
+        root = MCTSNode(None, None, 1 - position.toMove, position.hash)
+    root.parent = None
+    if timeBudgetMs is not None:
+        deadline = time.time() + timeBudgetMs / 1000.0
+        while time.time() < deadline:
+            mctsIteration(root, position, rolloutPolicy, explorationConstant)
+    else:
+        for iteration in range(iterations):
+            mctsIteration(root, position, rolloutPolicy, explorationConstant)
+    if len(root.children) == 0:
+        return randomPlayerWithValidation(heights, pieces, setUp)
+    best = max(root.children, key=lambda child: child.visits)
+    for child in best.children:
+        _mctsSubtrees[child.hash] = child
+    return position.describeMove(best.move)
+
+### End Monte Carlo Tree Search ###
 
 def displayAIBoard(heights, pieces):
     """Display the board in a human readable way."""
@@ -576,6 +2091,7 @@ ALL_PLAYERS = [defensivePlayer, timeLimitedNegamaxPlayer]
 ALL_PLAYERS = [timeLimitedNegamaxPlayer, negamaxPlayer]
 #ALL_PLAYERS = [defensivePlayer, montePlayer]
 #ALL_PLAYERS = [montePlayer, humanPlayer]
+#ALL_PLAYERS = [montePlayer, mctsPlayer]
 #ALL_PLAYERS = [timeLimitedNegamaxPlayer, humanPlayer]
 
 ### Game Simulator Code ###
@@ -645,9 +2161,118 @@ def build(heights, pieces, x, y, buildDir):
         raise IllegalMove('Space already at max height')
     heights[destY][destX] += 1
 
-def playGame(players):
+### Game Records ###
+
+# A file of game records starts with GAME_RECORD_MAGIC and then holds the records one after another.
+GAME_RECORD_MAGIC = b'SGR1'
+# Each record starts with the length of the rest of the record, the winner (NO_WINNER if the game
+# didn't finish), the number of set up squares and the lengths of the two player names.
+GAME_RECORD_HEADER = struct.Struct('<HBBBB')
+NO_WINNER = 255
+
+class GameRecord(object):
+    """A game as the set up squares, in the order they were placed (first player's first), and the
+    (pieceName, moveDir, buildDir) moves played, alternating from the first player.
+
+    Encoded, the set up squares and moves take one byte each, after the header and the names."""
+
+    def __init__(self, names, setUpSquares, moves, winner):
+        self.names = list(names)
+        self.setUpSquares = list(setUpSquares)
+        self.moves = list(moves)
+        self.winner = winner
+
+    def __eq__(self, other):
+        return isinstance(other, GameRecord) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def encode(self):
+        # Names are cut to 255 bytes, dropping any character the cut splits so that they still decode.
+        names = [name.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8') for name in self.names]
+        body = bytearray(names[0] + names[1])
+        body.extend(squareOf(*square) for square in self.setUpSquares)
+        body.extend(packMove(move) for move in self.moves)
+        winner = NO_WINNER if self.winner is None else self.winner
+        header = GAME_RECORD_HEADER.pack(GAME_RECORD_HEADER.size - 2 + len(body), winner, len(self.setUpSquares),
+                                         len(names[0]), len(names[1]))
+        return header + bytes(body)
+
+    @classmethod
+    def decode(cls, data):
+        """Decode a record from bytes, starting with its header."""
+        length, winner, setUpCount, firstNameLength, secondNameLength = GAME_RECORD_HEADER.unpack_from(data)
+        body = bytearray(data[GAME_RECORD_HEADER.size:2 + length])
+        namesEnd = firstNameLength + secondNameLength
+        names = [bytes(body[:firstNameLength]).decode('utf-8'), bytes(body[firstNameLength:namesEnd]).decode('utf-8')]
+        setUpSquares = [coordsOf(square) for square in body[namesEnd:namesEnd + setUpCount]]
+        moves = [unpackMove(code) for code in body[namesEnd + setUpCount:]]
+        return cls(names, setUpSquares, moves, None if winner == NO_WINNER else winner)
+
+class GameRecordWriter(object):
+    """Append game records to a file, e.g. playGame(players, recordGame=writer.write).
+
+    Each record is flushed as it is written, so an interrupted run keeps the games it finished."""
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(GAME_RECORD_MAGIC)
+
+    def write(self, record):
+        self.file.write(record.encode())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exceptionInfo):
+        self.close()
+
+def readGameRecords(path):
+    """Yield the GameRecords in a file one at a time, reading only as far as the record being returned."""
+    with open(path, 'rb') as recordFile:
+        if recordFile.read(len(GAME_RECORD_MAGIC)) != GAME_RECORD_MAGIC:
+            raise ValueError('Not a game record file: {}'.format(path))
+        while True:
+            lengthBytes = recordFile.read(2)
+            if len(lengthBytes) < 2:
+                return
+            length = struct.unpack('<H', lengthBytes)[0]
+            yield GameRecord.decode(lengthBytes + recordFile.read(length))
+
+def replayGame(record):
+    """Yield (heights, pieces, playerIndex, move) before each move of a recorded game, where pieces
+    is the board as the player to move sees it, as passed to the players."""
     heights = [[0] * 5 for i in range(5)]
     pieces = [[EMPTY] * 5 for i in range(5)]
+    for index, (x, y) in enumerate(record.setUpSquares):
+        pieces[y][x] = (index // 2, index % 2)
+    for turn, (pieceName, moveDir, buildDir) in enumerate(record.moves):
+        playerIndex = turn % 2
+        yield deepcopy(heights), convertPieces(playerIndex, pieces), playerIndex, (pieceName, moveDir, buildDir)
+        x, y = findPiece(pieces, playerIndex, pieceName)
+        x, y = move(heights, pieces, x, y, moveDir)
+        if heights[y][x] != MAX_HEIGHT - 1:
+            build(heights, pieces, x, y, buildDir)
+
+def endGame(players):
+    """Tell the players that have an endGame attribute, such as ponderingPlayer, that the game is over."""
+    for player in players:
+        if hasattr(player, 'endGame'):
+            player.endGame()
+
+def playGame(players, quiet=False, recordGame=None):
+    """Play a game and return the index of the winner. Nothing is printed if quiet is set. If recordGame
+    is given then it is called with a GameRecord of the game when it ends."""
+    heights = [[0] * 5 for i in range(5)]
+    pieces = [[EMPTY] * 5 for i in range(5)]
+    setUpSquares = []
+    moves = []
     
     winner = None
     try:
@@ -659,12 +2284,13 @@ def playGame(players):
                     winner = 1 - playerIndex
                     return winner
                 pieces[y][x] = (playerIndex, pieceNumber)
+                setUpSquares.append((x, y))
         
         # Play the game (the AI player can pick a piece to move, a move direction and a build direction).
         turnNumber = 0
         while True:
             for playerIndex, player in enumerate(players):
-                if OUTPUT_ALL_POSITIONS:
+                if OUTPUT_ALL_POSITIONS and not quiet:
                     print('Turn {}, {} ({}) to move:'.format(turnNumber, players[playerIndex].__name__, ['ab', 'yz'][playerIndex]))
                     displayBoard(heights, pieces)
                     pass
@@ -674,40 +2300,185 @@ def playGame(players):
                     x, y = move(heights, pieces, x, y, moveDir)
                     if heights[y][x] == MAX_HEIGHT - 1:
                         winner = playerIndex
+                        # The build never happens, so record it as DIRS[0] like Position.describeMove does.
+                        moves.append((pieceName, tuple(moveDir), DIRS[0]))
                         return winner
                     build(heights, pieces, x, y, buildDir)
+                    moves.append((pieceName, tuple(moveDir), tuple(buildDir)))
                 except IllegalMove as e:
-                    print(e.args[0])
+                    if not quiet:
+                        print(e.args[0])
                     winner = 1 - playerIndex
                     return winner
             turnNumber += 1
         return 0
     finally:
-        if winner == None:
+        endGame(players)
+        if recordGame is not None:
+            recordGame(GameRecord([player.__name__ for player in players], setUpSquares, moves, winner))
+        if quiet:
+            pass
+        elif winner == None:
             print('No winner')
         else:
             # Print end game position.
             loser = 1 - winner
             print('{} ({}) beats {} ({})'.format(players[winner].__name__, ['ab', 'yz'][winner], players[loser].__name__, ['ab', 'yz'][loser]))
-        displayBoard(heights, pieces)
-        print('\n')
-        pass
+        if not quiet:
+            displayBoard(heights, pieces)
+            print('\n')
 
-def main():
+### Fast Game Simulator ###
+
+def moveFromDescription(position, move):
+    """Convert a (pieceName, moveDir, buildDir) move by the player to move into the (fromSquare,
+    toSquare, buildSquare) format, or None if it names no piece, leaves the board or is missing a build.
+    Nothing else is checked. The build is dropped from winning moves."""
+    pieceName, moveDir, buildDir = move
+    if pieceName not in PIECES:
+        return None
+    fromSquare = position.workers[position.toMove][PIECES.index(pieceName)]
+    x, y = coordsOf(fromSquare)
+    x, y = x + moveDir[0], y + moveDir[1]
+    if not (0 <= x <= 4 and 0 <= y <= 4):
+        return None
+    toSquare = squareOf(x, y)
+    if position.heights[toSquare] == MAX_HEIGHT - 1:
+        return fromSquare, toSquare, None
+    if buildDir is None:
+        return None
+    x, y = x + buildDir[0], y + buildDir[1]
+    if not (0 <= x <= 4 and 0 <= y <= 4):
+        return None
+    return fromSquare, toSquare, squareOf(x, y)
+
+def listPolicy(player):
+    """Wrap a player that takes (heights, pieces, setUp) lists as a policy that takes a Position, for
+    use with simulateGame."""
+    def policy(position):
+        heights, pieces = position.toLists()
+        return moveFromDescription(position, player(heights, pieces, False))
+    policy.__name__ = player.__name__
+    return policy
+
+def startingPosition(players):
+    """Ask two (heights, pieces, setUp) players where to place their workers and return the Position,
+    with the first player to move, and the squares placed on. Raises IllegalMove, with the index of
+    the player as its second argument, if a player picks an occupied square."""
+    heights = [[0] * 5 for i in range(5)]
+    pieces = [[EMPTY] * 5 for i in range(5)]
+    setUpSquares = []
+    for playerIndex, player in enumerate(players):
+        for pieceNumber in range(2):
+            x, y = player(heights, convertPieces(playerIndex, pieces), True)
+            if pieces[y][x] != EMPTY:
+                raise IllegalMove('Can\'t place a worker on an occupied square {}'.format((x, y)), playerIndex)
+            pieces[y][x] = (playerIndex, pieceNumber)
+            setUpSquares.append((x, y))
+    workers = [[squareOf(*square) for square in setUpSquares[:2]], [squareOf(*square) for square in setUpSquares[2:]]]
+    return Position([0] * 25, workers), setUpSquares
+
+def simulateGame(policies, position, validate=False):
+    """Play a game out from a position, in place, and return (winner, moves).
+
+    policies holds a function for each player that takes the Position and returns a (fromSquare,
+    toSquare, buildSquare) move, or None if it has none. A player with no move loses. The moves are
+    trusted unless validate is set, in which case a player making an illegal move loses. moves lists
+    the moves played, so the caller can undo them or record them."""
+    moves = []
+    while not position.lastMoveWon():
+        move = policies[position.toMove](position)
+        if move is None or (validate and not position.isLegalMove(move)):
+            return 1 - position.toMove, moves
+        position.applyMove(move)
+        moves.append(move)
+    return 1 - position.toMove, moves
+
+def playFastGame(players, validate=False, recordGame=None):
+    """Play a game like playGame, but on one Position without copying, converting or (unless validate
+    is set) checking anything between turns, and without printing. Return the index of the winner.
+
+    players may be (heights, pieces, setUp) players, which are wrapped with listPolicy, or policies
+    given as (setUpPlayer, policy) pairs. playGame remains the checked reference."""
+    setUpPlayers = [player[0] if isinstance(player, tuple) else player for player in players]
+    policies = [player[1] if isinstance(player, tuple) else listPolicy(player) for player in players]
+    try:
+        position, setUpSquares = startingPosition(setUpPlayers)
+    except IllegalMove as e:
+        return 1 - e.args[1]
+    try:
+        winner, moves = simulateGame(policies, position, validate)
+    finally:
+        endGame(setUpPlayers)
+    if recordGame is not None:
+        descriptions = []
+        for move in reversed(moves):
+            position.undoMove(move)
+            descriptions.append(position.describeMove(move))
+        descriptions.reverse()
+        recordGame(GameRecord([player.__name__ for player in setUpPlayers], setUpSquares, descriptions, winner))
+    return winner
+
+### Tournament Code ###
+
+def _playTournamentGame(task):
+    """Play one tournament game and return (winnerIndex, loserIndex, record) with indexes into the
+    player list. record is the game's GameRecord if it was asked for, and None otherwise."""
+    players, playerPairing, gameSeed, quiet, record, fast = task
+    playerIndexes = list(playerPairing)
+    Random(gameSeed).shuffle(playerIndexes)
+    # The players use the module level random functions, so seed those too.
+    random.seed(gameSeed)
+    records = []
+    gamePlayers = [players[playerIndexes[0]], players[playerIndexes[1]]]
+    if fast:
+        winner = playFastGame(gamePlayers, recordGame=records.append if record else None)
+    else:
+        winner = playGame(gamePlayers, quiet, records.append if record else None)
+    return playerIndexes[winner], playerIndexes[1 - winner], records[0] if record else None
+
+def runTournament(players, numberOfGames, processes=1, seed=0, quiet=True, recordPath=None, fast=False):
+    """Play every pairing of players numberOfGames times and return a Counter of (winnerIndex, loserIndex).
+
+    Each game gets its own seed derived from seed, so the results don't depend on the number of
+    processes. With more than one process the games are shared out over a pool and the boards are
+    never displayed; the results are merged and reported by this process as they arrive. If recordPath
+    is given then the games are appended to it as GameRecords, in the order they finish. With fast set
+    the games are played with playFastGame, which trusts the players' moves and never displays them."""
+    tasks = []
+    for playerPairing in combinations(range(len(players)), 2):
+        for gameIndex in range(numberOfGames):
+            tasks.append((players, playerPairing, seed * 1000003 + len(tasks), quiet or processes > 1, recordPath is not None,
+                          fast))
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_playTournamentGame, tasks, max(1, len(tasks) // (processes * 8)))
+    else:
+        results = (_playTournamentGame(task) for task in tasks)
     score = Counter()
-    
-    for playerPairing in combinations(range(len(ALL_PLAYERS)), 2):
-        playerIndexes = list(playerPairing)
-        for gameIndex in range(NUMBER_OF_GAMES):
-            shuffle(playerIndexes)
-            players = [ALL_PLAYERS[playerIndexes[0]], ALL_PLAYERS[playerIndexes[1]]]
-            
-            winner = playGame(players)
-            loser = 1 - winner
-            score[(playerIndexes[winner], playerIndexes[loser])] += 1
-            print('Score now {} to {}'.format(score[(playerIndexes[winner], playerIndexes[loser])], score[(playerIndexes[loser], playerIndexes[winner])]))
+    writer = None if recordPath is None else GameRecordWriter(recordPath)
+    try:
+        for winnerIndex, loserIndex, record in results:
+            score[(winnerIndex, loserIndex)] += 1
+            if writer is not None:
+                writer.write(record)
+            if not quiet:
+                print('{} beats {}. Score now {} to {}'.format(players[winnerIndex].__name__, players[loserIndex].__name__,
+                                                               score[(winnerIndex, loserIndex)], score[(loserIndex, winnerIndex)]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if writer is not None:
+            writer.close()
+    return score
+
+def main():
+    # Displaying every position only makes sense when the games are played one at a time.
+    processes = 1 if OUTPUT_ALL_POSITIONS else NUMBER_OF_PROCESSES
+    score = runTournament(ALL_PLAYERS, NUMBER_OF_GAMES, processes, quiet=False, recordPath=RECORD_GAMES_PATH)
 
-    
     for playerIndexes, score in score.most_common():
         print('{:5d} {} beats {}'.format(score, ALL_PLAYERS[playerIndexes[0]].__name__, ALL_PLAYERS[playerIndexes[1]].__name__))
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A match server: clients connect over TCP or a Unix socket and play games against the engines.
+
+Each connection plays one game at a time, and any number of connections are served at once by one
+asyncio event loop. Engine turns are run in a pool of processes, so a long search never holds up
+the other games. Start it with, e.g.
+
+    python3 server.py --port 7654 --processes 4
+
+The protocol is one command per line. The client sends
+
+    NEW <engine> [FIRST|SECOND] [<clock seconds>]   start a game (the client moves first by default)
+    SETUP <x> <y>                                   place a worker
+    MOVE <piece> <dx> <dy> [<bx> <by>]              move a worker and build (no build for a winning move)
+    QUIT
+
+and the server answers with
+
+    HELLO <engine>,<engine>,...                     on connecting
+    GAME <player index> <clock ms>                  when a game starts
+    BOARD <heights> <pieces>                        before each of the client's turns
+    TURN SETUP|MOVE <clock ms left>                 when the server is waiting for the client
+    OPPONENT SETUP <x> <y>                          the engine's set up and moves, as it saw them
+    OPPONENT MOVE <piece> <dx> <dy> <bx> <by>
+    RESULT WIN|LOSS <reason>                        when the game ends
+    ERROR <message>                                 for a line that isn't a command, which is ignored
+
+BOARD gives the 25 heights and then the 25 squares as the client sees them, row by row, with the
+client's workers 'A' and 'B', the engine's 'O' and '.' for an empty square, as passed to the players
+in santorini.py. Moves are checked with Position.isLegalMove, and an illegal one loses the game, as
+in playGame. Each side has clock seconds for the whole game, and loses if it runs out.
+An engine that runs out loses at once, though its search carries on in the pool until it returns."""
+
+import argparse
+import asyncio
+import concurrent.futures
+
+from santorini import (EMPTY, MAX_HEIGHT, IllegalMove, Position, build, convertPieces, defensivePlayer, depthSearchPlayer,
+                       findPiece, move, moveFromDescription, negamaxPlayer, timeLimitedNegamaxPlayer, tryToClimb)
+
+# The engines clients can play against, by name.
+ENGINES = {
+    'climb': tryToClimb,
+    'defensive': defensivePlayer,
+    'depthSearch': depthSearchPlayer,
+    'negamax': negamaxPlayer,
+    'timeLimited': timeLimitedNegamaxPlayer,
+}
+CLOCK_SECONDS = 60.0
+LISTEN_BACKLOG = 1024
+
+def encodeBoard(heights, pieces):
+    return '{} {}'.format(''.join(str(height) for row in heights for height in row),
+                          ''.join('.' if piece == EMPTY else piece for row in pieces for piece in row))
+
+def decodeBoard(heightsStr, piecesStr):
+    """Return the heights and pieces lists for a BOARD line's fields."""
+    heights = [[int(height) for height in heightsStr[5 * y:5 * y + 5]] for y in range(5)]
+    pieces = [[EMPTY if piece == '.' else piece for piece in piecesStr[5 * y:5 * y + 5]] for y in range(5)]
+    return heights, pieces
+
+def isInteger(word):
+    try:
+        int(word)
+        return True
+    except ValueError:
+        return False
+
+class ServerGame(object):
+    """The board of a game on the server, with pieces as (playerIndex, pieceIndex) as in playGame."""
+
+    def __init__(self):
+        self.heights = [[0] * 5 for i in range(5)]
+        self.pieces = [[EMPTY] * 5 for i in range(5)]
+        self.placed = 0
+
+    def view(self, playerIndex):
+        """Return the heights and pieces as a player sees them."""
+        return [row[:] for row in self.heights], convertPieces(playerIndex, self.pieces)
+
+    def canMove(self, playerIndex):
+        return len(Position.fromLists(*self.view(playerIndex)).generateMoves()) > 0
+
+    def setUp(self, playerIndex, x, y):
+        if not (0 <= x <= 4 and 0 <= y <= 4) or self.pieces[y][x] != EMPTY:
+            raise IllegalMove('Can\'t place a worker on {}'.format((x, y)))
+        self.pieces[y][x] = (playerIndex, self.placed % 2)
+        self.placed += 1
+
+    def play(self, playerIndex, pieceName, moveDir, buildDir):
+        """Play a move, returning whether it wins, or raise IllegalMove."""
+        # move and build trust their callers, so check the step, climb and build against the Position.
+        position = Position.fromLists(*self.view(playerIndex))
+        turn = moveFromDescription(position, (pieceName, moveDir, buildDir))
+        if turn is None or not position.isLegalMove(turn):
+            raise IllegalMove('Can\'t play {}'.format((pieceName, moveDir, buildDir)))
+        x, y = findPiece(self.pieces, playerIndex, pieceName)
+        x, y = move(self.heights, self.pieces, x, y, moveDir)
+        if self.heights[y][x] == MAX_HEIGHT - 1:
+            return True
+        build(self.heights, self.pieces, x, y, buildDir)
+        return False
+
+class GameOver(Exception):
+    """Raised with (winnerIndex, reason) to end a game."""
+
+class ClientDisconnected(Exception):
+    pass
+
+class MatchServer(object):
+    """Serves games between clients and engines, with engine turns run by a pool of processes.
+    engines maps names to player functions, which must be defined at the top level of a module so
+    that the pool can pickle them."""
+
+    def __init__(self, processes=None, engines=ENGINES, clockSeconds=CLOCK_SECONDS):
+        self.pool = concurrent.futures.ProcessPoolExecutor(processes)
+        self.engines = engines
+        self.clockSeconds = clockSeconds
+        self.servers = []
+        self.connections = set()
+        self.gamesPlayed = 0
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Listen on a TCP port (0 picks a free one), or on a Unix socket if path is given. Return the
+        address listened on."""
+        # The default backlog of 100 drops connections when hundreds of clients connect at once.
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handleClient, path, backlog=LISTEN_BACKLOG)
+        else:
+            server = await asyncio.start_server(self.handleClient, host, port, backlog=LISTEN_BACKLOG)
+        self.servers.append(server)
+        return server.sockets[0].getsockname()
+
+    async def close(self):
+        """Stop listening, end the games in progress and shut the pool down."""
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for connection in self.connections:
+            connection.cancel()
+        await asyncio.gather(*self.connections)
+        self.pool.shutdown()
+
+    async def handleClient(self, reader, writer):
+        send = lambda line: writer.write((line + '\n').encode())
+        send('HELLO ' + ','.join(sorted(self.engines)))
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode().split()
+                if words == ['QUIT']:
+                    break
+                if not words or words[0] != 'NEW':
+                    send('ERROR Expected NEW or QUIT')
+                    continue
+                try:
+                    engineName, clientIndex, clockSeconds = self.parseNew(words)
+                except ValueError as e:
+                    send('ERROR ' + str(e))
+                    continue
+                await self.playGame(reader, send, engineName, clientIndex, clockSeconds)
+                await writer.drain()
+        except (ClientDisconnected, asyncio.CancelledError):
+            # Cancelled by close, which waits for the connections to finish.
+            pass
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    def parseNew(self, words):
+        if len(words) < 2 or words[1] not in self.engines:
+            raise ValueError('Unknown engine, expected one of ' + ','.join(sorted(self.engines)))
+        clientIndex = 0
+        if len(words) > 2:
+            if words[2] not in ('FIRST', 'SECOND'):
+                raise ValueError('Expected FIRST or SECOND')
+            clientIndex = ['FIRST', 'SECOND'].index(words[2])
+        clockSeconds = float(words[3]) if len(words) > 3 else self.clockSeconds
+        return words[1], clientIndex, clockSeconds
+
+    async def playGame(self, reader, send, engineName, clientIndex, clockSeconds):
+        game = ServerGame()
+        clocks = [clockSeconds, clockSeconds]
+        send('GAME {} {}'.format(clientIndex, int(clockSeconds * 1000)))
+        try:
+            for playerIndex in [0, 0, 1, 1]:
+                if playerIndex == clientIndex:
+                    words = await self.clientTurn(reader, send, game, clocks, playerIndex, 'SETUP', [3])
+                    square = int(words[1]), int(words[2])
+                else:
+                    square = await self.engineTurn(engineName, game, clocks, playerIndex, True)
+                self.checkMove(game.setUp, playerIndex, square)
+                if playerIndex != clientIndex:
+                    send('OPPONENT SETUP {} {}'.format(*square))
+            while True:
+                for playerIndex in range(2):
+                    if not game.canMove(playerIndex):
+                        raise GameOver(1 - playerIndex, 'no moves')
+                    if playerIndex == clientIndex:
+                        words = await self.clientTurn(reader, send, game, clocks, playerIndex, 'MOVE', [4, 6])
+                        turn = (words[1], (int(words[2]), int(words[3])),
+                                (int(words[4]), int(words[5])) if len(words) == 6 else None)
+                    else:
+                        turn = await self.engineTurn(engineName, game, clocks, playerIndex, False)
+                    won = self.checkMove(game.play, playerIndex, turn)
+                    if playerIndex != clientIndex:
+                        pieceName, moveDir, buildDir = turn
+                        send('OPPONENT MOVE {} {} {}'.format(pieceName, *moveDir) +
+                             ('' if won else ' {} {}'.format(*buildDir)))
+                    if won:
+                        raise GameOver(playerIndex, 'reached height {}'.format(MAX_HEIGHT - 1))
+        except GameOver as e:
+            winner, reason = e.args
+            send('RESULT {} {}'.format('WIN' if winner == clientIndex else 'LOSS', reason))
+            self.gamesPlayed += 1
+
+    def checkMove(self, play, playerIndex, turn):
+        """Play a set up square or move with game.setUp or game.play, ending the game if it's illegal
+        (or, from an engine, not a turn at all)."""
+        try:
+            return play(playerIndex, *turn)
+        except (IllegalMove, TypeError, ValueError) as e:
+            raise GameOver(1 - playerIndex, 'illegal move: {}'.format(e))
+
+    async def clientTurn(self, reader, send, game, clocks, playerIndex, command, lengths):
+        """Wait for the client's command with one of the given numbers of words, all numbers after the
+        command (and piece name), and return its words."""
+        send('BOARD ' + encodeBoard(*game.view(playerIndex)))
+        send('TURN {} {}'.format(command, int(clocks[playerIndex] * 1000)))
+        loop = asyncio.get_event_loop()
+        while True:
+            startTime = loop.time()
+            try:
+                line = await asyncio.wait_for(reader.readline(), max(clocks[playerIndex], 0))
+            except asyncio.TimeoutError:
+                raise GameOver(1 - playerIndex, 'out of time')
+            clocks[playerIndex] -= loop.time() - startTime
+            if not line:
+                raise ClientDisconnected()
+            words = line.decode().split()
+            numbers = words[2 if command == 'MOVE' else 1:]
+            if words and words[0] == command and len(words) in lengths and all(isInteger(word) for word in numbers):
+                return words
+            send('ERROR Expected {}'.format(command))
+
+    async def engineTurn(self, engineName, game, clocks, playerIndex, setUp):
+        loop = asyncio.get_event_loop()
+        startTime = loop.time()
+        heights, pieces = game.view(playerIndex)
+        turn = loop.run_in_executor(self.pool, self.engines[engineName], heights, pieces, setUp)
+        try:
+            result = await asyncio.wait_for(turn, max(clocks[playerIndex], 0))
+        except asyncio.TimeoutError:
+            raise GameOver(1 - playerIndex, 'out of time')
+        except Exception as e:
+            raise GameOver(1 - playerIndex, 'engine failed: {!r}'.format(e))
+        clocks[playerIndex] -= loop.time() - startTime
+        return result
+
+async def playRemoteGame(reader, writer, player, engineName, clientIndex=0, clockSeconds=None):
+    """Play a game on a match server with a player function from santorini.py, and return the RESULT
+    line's words. reader and writer are a connection that has read the HELLO line."""
+    send = lambda line: writer.write((line + '\n').encode())
+    send(' '.join(['NEW', engineName, ['FIRST', 'SECOND'][clientIndex]] + ([] if clockSeconds is None else [str(clockSeconds)])))
+    while True:
+        words = (await reader.readline()).decode().split()
+        if not words:
+            raise ConnectionError('Server closed the connection')
+        if words[0] == 'BOARD':
+            heights, pieces = decodeBoard(words[1], words[2])
+        elif words[0] == 'TURN':
+            if words[1] == 'SETUP':
+                x, y = player(heights, pieces, True)
+                send('SETUP {} {}'.format(x, y))
+            else:
+                pieceName, moveDir, buildDir = player(heights, pieces, False)
+                send('MOVE {} {} {} {} {}'.format(pieceName, moveDir[0], moveDir[1], buildDir[0], buildDir[1]))
+        elif words[0] == 'RESULT':
+            return words
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve games against the engines in santorini.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7654)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--processes', type=int, help='engine processes (by default one per CPU)')
+    parser.add_argument('--clock', type=float, default=CLOCK_SECONDS, help='default seconds per side per game')
+    args = parser.parse_args()
+
+    async def serve():
+        server = MatchServer(args.processes, clockSeconds=args.clock)
+        print('Listening on {}'.format(await server.start(args.host, args.port, args.unix)))
+        try:
+            await asyncio.gather(*[listener.serve_forever() for listener in server.servers])
+        finally:
+            await server.close()
+
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
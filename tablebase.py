@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Build the endgame tablebase probed by the negamax search.
+
+A layout is the set of squares below MAX_HEIGHT. Every position with a given layout is solved exactly
+by working back from the positions with the most building: each turn builds, so a position's children
+either have a higher height index in the same layout or, when a dome is built, a smaller layout that
+is solved first. Layouts are taken from games between two players, from random domed boards, or both,
+and only those with at most --threshold open squares are kept, e.g.
+
+    python tablebase.py --threshold 6 --games 100 --random 20
+
+writes tablebase.bin next to santorini.py, where the search finds it. A layout of six squares has
+about 370,000 positions and takes a few seconds with its smaller layouts. Games seldom get down to so
+few open squares, so most layouts come from --random."""
+
+import argparse
+import random
+import time
+from itertools import combinations
+
+import santorini
+from santorini import (MAX_HEIGHT, NEIGHBOUR_MASKS, TABLEBASE_PATH, bitsOf, canonicalMask, decodeResult,
+                       encodeResult, layoutIndex, placementsIn, writeTablebase)
+
+def solveLayout(mask, tables):
+    """Solve every position whose open squares are mask, and those of every smaller layout it can
+    become, adding a bytearray of encoded results (indexed by layoutIndex) to tables for each."""
+    if mask in tables:
+        return
+    squares = list(bitsOf(mask))
+    count = len(squares)
+    if count < 4:
+        tables[mask] = bytearray()
+        return
+    for square in squares:
+        solveLayout(mask & ~(1 << square), tables)
+    neighbours = [[other for other in range(count) if NEIGHBOUR_MASKS[squares[index]] >> squares[other] & 1]
+                  for index in range(count)]
+    placements = [(movers, opponents) for movers in combinations(range(count), 2)
+                  for opponents in combinations([index for index in range(count) if index not in movers], 2)]
+    table = bytearray(MAX_HEIGHT ** count * placementsIn(count))
+    for heightIndex in reversed(range(MAX_HEIGHT ** count)):
+        heights = [heightIndex // MAX_HEIGHT ** index % MAX_HEIGHT for index in range(count)]
+        for movers, opponents in placements:
+            table[layoutIndex(heights, movers, opponents)] = solvePosition(mask, squares, neighbours, heights, movers,
+                                                                          opponents, table, tables)
+    tables[mask] = table
+
+def solvePosition(mask, squares, neighbours, heights, movers, opponents, table, tables):
+    """Return the encoded result of one position, given the results of all its children."""
+    if heights[opponents[0]] == MAX_HEIGHT - 1 or heights[opponents[1]] == MAX_HEIGHT - 1:
+        return encodeResult(False, 0)
+    quickestWin = None
+    slowestLoss = 0
+    for mover, other in [movers, reversed(movers)]:
+        for destination in neighbours[mover]:
+            if destination == other or destination in opponents or heights[destination] > heights[mover] + 1:
+                continue
+            if heights[destination] == MAX_HEIGHT - 1:
+                return encodeResult(True, 1)
+            newMovers = (other, destination)
+            for buildIndex in neighbours[destination]:
+                if buildIndex == other or buildIndex in opponents:
+                    continue
+                if heights[buildIndex] == MAX_HEIGHT - 1:
+                    # Building a dome moves the position into the layout without that square.
+                    remap = lambda index: index - (index > buildIndex)
+                    childHeights = heights[:buildIndex] + heights[buildIndex + 1:]
+                    childTable = tables[mask & ~(1 << squares[buildIndex])]
+                    code = childTable[layoutIndex(childHeights, [remap(index) for index in opponents],
+                                                  [remap(index) for index in newMovers])]
+                else:
+                    heights[buildIndex] += 1
+                    code = table[layoutIndex(heights, opponents, newMovers)]
+                    heights[buildIndex] -= 1
+                childWon, childPlies = decodeResult(code)
+                if not childWon:
+                    if quickestWin is None or childPlies + 1 < quickestWin:
+                        quickestWin = childPlies + 1
+                else:
+                    slowestLoss = max(slowestLoss, childPlies + 1)
+    if quickestWin is not None:
+        return encodeResult(True, quickestWin)
+    return encodeResult(False, slowestLoss)
+
+def gameLayouts(players, numberOfGames, threshold):
+    """Return the layouts with at most threshold open squares seen in games between two players."""
+    layouts = set()
+    build = santorini.build
+
+    def recordingBuild(heights, pieces, x, y, buildDir):
+        build(heights, pieces, x, y, buildDir)
+        mask = sum(1 << (5 * row + column) for row in range(5) for column in range(5) if heights[row][column] < MAX_HEIGHT)
+        if bin(mask).count('1') <= threshold:
+            layouts.add(mask)
+
+    santorini.build = recordingBuild
+    try:
+        for gameIndex in range(numberOfGames):
+            santorini.playGame(players, quiet=True)
+    finally:
+        santorini.build = build
+    return layouts
+
+def randomLayouts(numberOfLayouts, threshold):
+    return set(sum(1 << square for square in random.sample(range(25), threshold)) for index in range(numberOfLayouts))
+
+def buildTablebase(layouts, threshold):
+    """Return the canonical tables for the given layouts and every smaller layout they can become."""
+    tables = {}
+    for mask in layouts:
+        solveLayout(canonicalMask(mask)[0], tables)
+    canonicalTables = {}
+    for mask in list(tables):
+        canonical = canonicalMask(mask)[0]
+        if canonical not in tables:
+            solveLayout(canonical, tables)
+        if 4 <= bin(canonical).count('1') <= threshold:
+            canonicalTables[canonical] = tables[canonical]
+    return canonicalTables
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the endgame tablebase probed by the negamax search.')
+    parser.add_argument('--threshold', type=int, default=6, help='most open squares in a solved layout')
+    parser.add_argument('--games', type=int, default=100, help='games between defensive players to take layouts from')
+    parser.add_argument('--random', type=int, default=20, help='number of random layouts of threshold squares to add')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=TABLEBASE_PATH, help='where to write the tablebase')
+    args = parser.parse_args()
+
+    startTime = time.time()
+    random.seed(args.seed)
+    players = [santorini.defensivePlayer, santorini.defensivePlayer]
+    layouts = gameLayouts(players, args.games, args.threshold) | randomLayouts(args.random, args.threshold)
+    tables = buildTablebase(layouts, args.threshold)
+    writeTablebase(tables, args.threshold, args.output)
+    print('Wrote {} layouts ({} positions) to {} in {:.1f}s'.format(len(tables), sum(len(table) for table in tables.values()),
+                                                                 args.output, time.time() - startTime))
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+import santorini
 from santorini import *
 
 class SantoriniTest(unittest.TestCase):
@@ -81,6 +88,60 @@ class SantoriniTest(unittest.TestCase):
         
         self.assertEqual(set(builds), set([(1, -1), (1, 1)]))
 
+    def testValidMovesByHeight(self):
+        """Test that the moves are grouped by the height they reach, in the order of DIRS."""
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        # Call the method under test.
+        movesByHeight = validMovesByHeight(heights, pieces, 1, 1)
+
+        self.assertEqual(dict(movesByHeight), {0: [((1, -1), (2, 0)), ((-1, 1), (0, 2)), ((-1, 0), (0, 1)), ((-1, -1), (0, 0))],
+                                              1: [((1, 0), (2, 1)), ((0, 1), (1, 2)), ((0, -1), (1, 0))]})
+        self.assertEqual(len(NEIGHBOURS[0]), 3)
+        self.assertEqual(len(NEIGHBOURS[12]), 8)
+
+    def testPositionListRoundTrip(self):
+        pieces = self.setUpPieces(['  O  ', ' A   ', ' O   ', '     ', '   B '])
+        heights = self.setUpHeights(['00000', '00000', '00000', '00012', '00314'])
+        position = Position.fromLists(heights, pieces)
+        self.assertEqual(position.workers, [[6, 23], [2, 11]])
+        self.assertEqual(position.toLists(), (heights, pieces))
+
+    def testPositionMovesMatchListHelpers(self):
+        """Test that the bitboard move generator agrees with validMoves and validBuilds."""
+        pieces = self.setUpPieces(['OB   ', ' A   ', 'O    ', '     ', '     '])
+        heights = self.setUpHeights(['00000', '01200', '03100', '00040', '00000'])
+        position = Position.fromLists(heights, pieces)
+        expected = set()
+        for pieceName in PIECES:
+            x, y = findPiecePos(pieces, pieceName)
+            for moveDir in validMoves(heights, pieces, x, y):
+                for buildDir in validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName):
+                    expected.add((pieceName, moveDir, buildDir))
+        # Call the method under test.
+        moves = [position.describeMove(move) for move in position.generateMoves()]
+
+        self.assertEqual(len(moves), len(expected))
+        self.assertEqual(set(moves), expected)
+
+    def testPositionApplyAndUndoMove(self):
+        pieces = self.setUpPieces(['OB   ', ' A   ', 'O    ', '     ', '     '])
+        heights = self.setUpHeights(['00000', '01200', '03100', '00040', '00000'])
+        position = Position.fromLists(heights, pieces)
+        # B moves from (1,0) to (2,1) and builds back on (1,0).
+        move = (squareOf(1, 0), squareOf(2, 1), squareOf(1, 0))
+        position.applyMove(move)
+
+        self.assertEqual(position.toMove, 1)
+        childHeights, childPieces = position.toLists()
+        self.assertEqual(childHeights[0][1], 1)
+        self.assertEqual(childPieces[1][2], OPPONENT)
+        self.assertEqual(set(PIECES), set([childPieces[0][0], childPieces[2][0]]))
+        position.undoMove(move)
+        self.assertEqual(position.toMove, 0)
+        self.assertEqual(position.toLists(), (heights, pieces))
+        self.assertEqual(position.levels, Position.fromLists(heights, pieces).levels)
+
     def DtestNegamaxPlayerDepth0Win(self):
         pieces = self.setUpPieces(['OBO  ', ' A   ', '     ', '     ', '     '])
         heights = self.setUpHeights(['02200', '30100', '33333', '33333', '33333'])
@@ -122,6 +183,300 @@ class SantoriniTest(unittest.TestCase):
         self.assertEqual(negamax(node, 3, -1000, 1000, -1), -1000)
         self.assertEqual(negamax(node, 4, -1000, 1000, -1), -1000)
         
+    def testPositionEvaluationIsIncremental(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        for move in position.generateMoves():
+            position.applyMove(move)
+            fresh = position.copy()
+            self.assertEqual(position.evaluate(), fresh.evaluate())
+            self.assertEqual(position.evaluate(), heuristic(position.toLists() + (1,), 0))
+            self.assertEqual(position.lastMoveWon(), fresh.lastMoveWon())
+            position.undoMove(move)
+        self.assertEqual(position.evaluate(), heuristic((heights, pieces, 1), 0))
+
+    def testNegamaxTranspositionTable(self):
+        """Test that searching with a transposition table gives the same scores and reuses results."""
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        table = TranspositionTable(1 << 10)
+        for depth in range(4):
+            expected = negamax((heights, pieces, -1), depth, -1000, 1000, -1)
+            self.assertEqual(negamax((heights, pieces, -1), depth, -1000, 1000, -1, table=table), expected)
+        self.assertTrue(table.hits > 0)
+
+    def testOrderingIsLazy(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        hintMove = position.generateMoves()[-1]
+        generated = []
+        generateMoves = position.generateMoves
+        position.generateMoves = lambda: generated.append(True) or generateMoves()
+        # Call the method under test.
+        moves = KillerHistoryOrdering().order(position, 2, hintMove)
+
+        self.assertEqual(next(moves), hintMove)
+        self.assertEqual(generated, [])
+        self.assertNotIn(hintMove, list(moves))
+        self.assertEqual(generated, [True])
+        self.assertFalse(position.isLegalMove((hintMove[0], hintMove[1], hintMove[0] + 25)))
+
+    def testMoveOrderingsGiveTheSameScores(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        ordering = KillerHistoryOrdering()
+        for depth in range(5):
+            expected = negamax((heights, pieces, -1), depth, -1000, 1000, -1, ordering=HeightOrdering())
+            self.assertEqual(negamax((heights, pieces, -1), depth, -1000, 1000, -1, ordering=ordering), expected)
+        self.assertTrue(len(ordering.killers) > 0 and len(ordering.history) > 0)
+        # Killer moves are searched before other quiet moves.
+        position = Position.fromLists(heights, pieces)
+        killer = position.generateMoves()[-1]
+        ordering.killers[3] = [killer]
+        self.assertEqual(next(ordering.order(position, 3, None)), killer)
+        self.assertEqual(sorted(ordering.order(position, 3, None)), sorted(position.generateMoves()))
+
+    def testPositionHashIsIncremental(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        originalHash = position.hash
+        for move in position.generateMoves():
+            position.applyMove(move)
+            self.assertEqual(position.hash, position.copy().hash)
+            position.undoMove(move)
+        self.assertEqual(position.hash, originalHash)
+
+    def testCanonicalPositionIsSharedBySymmetries(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        canonicalHeights, canonicalPieces, symmetry = canonicalPosition(heights, pieces)
+        for otherSymmetry in range(8):
+            image = position.transformed(otherSymmetry)
+            self.assertEqual(image.canonicalHash()[0], position.canonicalHash()[0])
+            self.assertEqual(canonicalPosition(*image.toLists())[:2], (canonicalHeights, canonicalPieces))
+        # A move in the canonical position maps back to a legal move here.
+        canonicalMove = Position.fromLists(canonicalHeights, canonicalPieces).describeMove(
+            Position.fromLists(canonicalHeights, canonicalPieces).generateMoves()[0])
+        pieceName, moveDir, buildDir = transformMove(canonicalMove, SYMMETRY_INVERSES[symmetry])
+        x, y = findPiecePos(pieces, pieceName)
+        self.assertIn(moveDir, validMoves(heights, pieces, x, y))
+
+    def testSymmetricRootMovesAreDeduplicated(self):
+        pieces = self.setUpPieces(['     ', '     ', 'A   B', '     ', ' O O '])
+        heights = self.setUpHeights(['00000', '00100', '01210', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        moves = position.generateMoves()
+        uniqueMoves = position.uniqueMoves(moves)
+
+        self.assertEqual(position.symmetries(), [0, 4])
+        self.assertEqual(len(uniqueMoves) * 2, len(moves) + len([move for move in moves if transformSquareMove(move, 4) == move]))
+        self.assertEqual(uniqueMoves, [move for move in moves if move in uniqueMoves])
+
+    def testTranspositionTableFindsMirroredPositions(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        table = TranspositionTable(1 << 10)
+        score = searchNegamax(position, 2, -1000, 1000, table)
+        mirrored = position.transformed(6)
+        tableScore, bestMove = probeTable(table, mirrored, 2, -1000, 1000)
+
+        self.assertEqual(tableScore, score)
+        self.assertIn(bestMove, mirrored.generateMoves())
+        self.assertEqual(searchNegamax(mirrored, 2, -1000, 1000), score)
+
+    def testPonderingReusesPredictedReply(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        table = TranspositionTable()
+        player = ponderingPlayer(negamaxPlayer, table, KillerHistoryOrdering())
+        options = dict(startDepth=2, table=table, openingBook=None, ordering=player.ponderer.ordering)
+        player.ponderer.maxDepth = 2
+        move = player(heights, pieces, False, **options)
+        player.ponderer.thread.join()
+        self.assertEqual(player.ponderer.completedDepth, 2)
+        # The opponent plays the predicted reply.
+        position = Position.fromLists(heights, pieces)
+        position.applyMove(moveFromDescription(position, move))
+        position.applyMove(player.ponderer.replies[0])
+        nextHeights, nextPieces = position.toLists()
+        expected, coldStats = withSearchStats(negamaxPlayer, nextHeights, nextPieces, startDepth=2, table=TranspositionTable(),
+                                              openingBook=None, ordering=KillerHistoryOrdering())
+        # Call the method under test.
+        nextMove, stats = withSearchStats(player, nextHeights, nextPieces, **options)
+
+        self.assertEqual(nextMove, expected)
+        self.assertTrue(stats.nodes() * 20 < coldStats.nodes())
+        player.ponderer.stop()
+
+    def testPonderingStopsWhenGameEnds(self):
+        for fast in [False, True]:
+            player = ponderingPlayer(randomPlayerWithValidation, TranspositionTable(), KillerHistoryOrdering())
+            random.seed(0)
+            # Call the method under test.
+            winner = (playFastGame if fast else playGame)([player, defensivePlayer], recordGame=None)
+
+            self.assertEqual(winner, 1)
+            self.assertIsNone(player.ponderer.thread)
+            self.assertNotIn('ponderer', [thread.name for thread in threading.enumerate()])
+
+    def testEvaluationCacheWarmStartsSearch(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        options = dict(startDepth=3, openingBook=None, evaluationCache=path)
+        coldMove, coldStats = withSearchStats(negamaxPlayer, heights, pieces, table=TranspositionTable(), **options)
+        # Forget the opened cache, as a new process would.
+        santorini._evaluationCaches.clear()
+        # Call the method under test.
+        warmMove, warmStats = withSearchStats(negamaxPlayer, heights, pieces, table=TranspositionTable(), **options)
+
+        self.assertEqual(warmMove, coldMove)
+        self.assertEqual(warmStats.score, coldStats.score)
+        self.assertTrue(warmStats.nodes() * 10 < coldStats.nodes())
+        santorini._evaluationCaches.clear()
+
+    def testEvaluationCacheLeavesTableHitRateAlone(self):
+        cache = EvaluationCache(os.path.join(tempfile.mkdtemp(), 'cache.db'))
+        keys = [1 << 60, 2 << 60]
+        table = TranspositionTable()
+        table.store(keys[0], 3, 7, EXACT, (0, 1, 2))
+        # Call the methods under test.
+        saveTableEntries(table, cache, keys)
+        warmTable = TranspositionTable()
+        warmStartTable(warmTable, cache, keys)
+
+        self.assertEqual(warmTable.peek(keys[0])[:5], (keys[0], 3, 7, EXACT, (0, 1, 2)))
+        self.assertIsNone(warmTable.peek(keys[1]))
+        self.assertEqual((table.hits, table.misses, warmTable.hits, warmTable.misses), (0, 0, 0, 0))
+
+    def testEvaluationCacheEvictsShallowEntries(self):
+        cache = EvaluationCache(os.path.join(tempfile.mkdtemp(), 'cache.db'), maxEntries=4)
+        keys = [index << 60 for index in range(5)]
+        for index in range(3):
+            cache.store(keys[index], 2, index, EXACT, (index, index + 1, None))
+            cache.flush()
+            time.sleep(0.01)
+        cache.lookup([keys[0]])
+        cache.flush()
+        for index in range(3, 5):
+            cache.store(keys[index], 3, index, LOWER_BOUND, (index, index + 1, 2))
+        cache.flush()
+        # Shallower results don't replace deeper ones.
+        cache.store(keys[3], 2, 0, EXACT, None)
+        cache.flush()
+
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.lookup(keys), {keys[0]: (2, 0, EXACT, (0, 1, None)), keys[2]: (2, 2, EXACT, (2, 3, None)),
+                                              keys[3]: (3, 3, LOWER_BOUND, (3, 4, 2)), keys[4]: (3, 4, LOWER_BOUND, (4, 5, 2))})
+        cache.close()
+
+    def testOpeningBookLookupIsSymmetric(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['00000', '00000', '00000', '00000', '00000'])
+        bookMove = ('A', (1, 0), (0, 1))
+        key, symmetry = bookKey(heights, pieces)
+        setUpKey, setUpSymmetry = bookKey(heights, self.setUpPieces(['     ', '     ', '     ', ' O   ', '     ']))
+        book = {key: encodeBookMove(transformMove(bookMove, symmetry), False),
+                setUpKey: encodeBookMove(coordsOf(SYMMETRY_SQUARES[setUpSymmetry][squareOf(2, 2)]), True)}
+        path = os.path.join(tempfile.mkdtemp(), 'book.bin')
+        writeOpeningBook(book, path)
+
+        self.assertEqual(readOpeningBook(path), book)
+        self.assertEqual(negamaxPlayer(heights, pieces, False, openingBook=path), bookMove)
+        mirroredHeights, mirroredPieces = Position.fromLists(heights, pieces).transformed(4).toLists()
+        self.assertEqual(openingBookMove(mirroredHeights, mirroredPieces, False, path), transformMove(bookMove, 4))
+        self.assertEqual(openingBookMove(heights, self.setUpPieces(['     ', '     ', '     ', '   O ', '     ']), True, path), (2, 2))
+        self.assertEqual(openingBookMove(heights, self.setUpPieces(['     ', '     ', '     ', '     ', '     ']), True, path), None)
+
+    def testBatchHeuristicMatchesHeuristic(self):
+        nodes = [(self.setUpHeights(['01000', '02100', '01020', '00100', '00000']),
+                  self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     ']), 1),
+                 (self.setUpHeights(['00000', '00000', '00000', '02024', '02204']),
+                  self.setUpPieces(['O    ', '     ', '     ', '     ', ' OAB ']), 1)]
+        owners = [[[{EMPTY: 0, 'A': 1, 'B': 1, OPPONENT: -1}[piece] for piece in row] for row in pieces] for _, pieces, _ in nodes]
+        # Call the method under test.
+        scores = batchHeuristic([heights for heights, _, _ in nodes], owners)
+
+        self.assertEqual(list(scores), [heuristic(node, 0) for node in nodes])
+
+    def testSearchFrontierMatchesNegamax(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        position = Position.fromLists(heights, pieces)
+        moves = position.generateMoves()
+        expectedScores = []
+        for move in moves:
+            position.applyMove(move)
+            expectedScores.append(position.evaluate())
+            position.undoMove(move)
+
+        scores = evaluateChildren(position, moves)
+        self.assertEqual(scores, expectedScores)
+        self.assertEqual(set(type(score) for score in scores), set([int]))
+        score = searchFrontier(position)[0]
+        self.assertEqual(score, negamax((heights, pieces, -1), 1, -1000, 1000, -1))
+        self.assertIs(type(score), int)
+
+    @unittest.skipIf(santorini.numpy is None, 'numpy is not installed')
+    def testBatchFrontierSearchCanBeCachedAndSerialised(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        options = dict(startDepth=3, openingBook=None, table=TranspositionTable())
+        expected, expectedStats = withSearchStats(negamaxPlayer, heights, pieces, **options)
+        santorini.BATCH_FRONTIER = True
+        try:
+            # Call the method under test.
+            move, stats = withSearchStats(negamaxPlayer, heights, pieces, evaluationCache=path, **dict(options, table=TranspositionTable()))
+        finally:
+            santorini.BATCH_FRONTIER = False
+
+        self.assertEqual((move, stats.score), (expected, expectedStats.score))
+        self.assertEqual(json.loads(json.dumps(stats.score)), expectedStats.score)
+
+    def testSearchStats(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        expected = negamaxPlayer(heights, pieces, False, startDepth=2, table=None)
+        # Call the method under test.
+        move, stats = withSearchStats(negamaxPlayer, heights, pieces, startDepth=2, table=None)
+
+        self.assertEqual(move, expected)
+        self.assertEqual(stats.completedDepth, 2)
+        self.assertEqual(stats.nodesByDepth[2], len(Position.fromLists(heights, pieces).generateMoves()))
+        self.assertEqual(stats.nodes(), sum(stats.nodesByDepth[depth] for depth in range(3)))
+        self.assertTrue(0 < stats.cutoffs <= stats.expandedNodes)
+        self.assertTrue(stats.firstMoveCutoffs <= stats.cutoffs)
+        self.assertTrue(stats.transpositions > 0)
+
+    def testAnalysePositions(self):
+        positions = [(self.setUpHeights(['01000', '02100', '01020', '00100', '00000']),
+                      self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])),
+                     (self.setUpHeights(['00000', '00000', '00000', '02024', '02204']),
+                      self.setUpPieces(['O    ', '     ', '     ', '     ', ' OAB ']))]
+        read = []
+        def readPositions():
+            for position in positions * 3:
+                read.append(position)
+                yield position
+        expected = [analysePosition(heights, pieces, depth=2)[:3] for heights, pieces in positions] * 3
+        # Call the method under test.
+        results = analysePositions(readPositions(), depth=2, processes=2, maxInFlight=2)
+
+        self.assertEqual(next(results)[:3], expected[0])
+        self.assertEqual(len(read), 2)
+        self.assertEqual([expected[0]] + [result[:3] for result in results], expected)
+        self.assertEqual(expected[1][1], 1000)
+        # The second search of a position starts with a warm transposition table.
+        first, second = analysePositions([positions[0]] * 2, depth=3)
+        self.assertEqual(first[:3], second[:3])
+        self.assertTrue(second[3] < first[3])
+
     def testNegamaxPlayerDepth1Win(self):
         pieces = self.setUpPieces(['O    ', 
                                    '     ', 
@@ -139,5 +494,162 @@ class SantoriniTest(unittest.TestCase):
         self.assertEqual(moveDir, (-1, -1))
         self.assertEqual(buildDir, (1, 0))
 
+    def testDepthSearchPlayerNodeBudget(self):
+        pieces = self.setUpPieces(['O    ', '     ', '     ', '     ', ' OAB '])
+        heights = self.setUpHeights(['00000', '00000', '00000', '02024', '02204'])
+        # Call the method under test.
+        move, stats = withSearchStats(depthSearchPlayer, heights, pieces)
+        smallMove, smallStats = withSearchStats(depthSearchPlayer, heights, pieces, nodeBudget=200)
+
+        self.assertEqual(move[:2], ('B', (-1, -1)))
+        self.assertTrue(stats.score >= 1000)
+        self.assertTrue(stats.nodes() <= DEPTH_SEARCH_NODE_BUDGET)
+        self.assertTrue(smallStats.nodes() < 2 * 200 < stats.nodes())
+        position = Position.fromLists(heights, pieces)
+        self.assertTrue(position.isLegalMove(moveFromDescription(position, smallMove)))
+
+    def testParallelNegamaxPlayerMatchesSequential(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        expected = negamaxPlayer(heights, pieces, False, startDepth=2, table=None)
+
+        self.assertEqual(negamaxPlayer(heights, pieces, False, startDepth=2, processes=2), expected)
+
+    def testTimeLimitedNegamaxPlayerFindsWin(self):
+        pieces = self.setUpPieces(['O    ', '     ', '     ', '     ', ' OAB '])
+        heights = self.setUpHeights(['00000', '00000', '00000', '02024', '02204'])
+        pieceName, moveDir, buildDir = timeLimitedNegamaxPlayer(heights, pieces, False, timeBudgetMs=1000)
+
+        self.assertEqual((pieceName, moveDir, buildDir), ('B', (-1, -1), (1, 0)))
+
+    def testTimeLimitedNegamaxPlayerKeepsToBudget(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        startTime = time.time()
+        pieceName, moveDir, buildDir = timeLimitedNegamaxPlayer(heights, pieces, False, timeBudgetMs=100, table=None)
+
+        self.assertTrue(time.time() - startTime < 0.5)
+        x, y = findPiecePos(pieces, pieceName)
+        self.assertIn(moveDir, validMoves(heights, pieces, x, y))
+        self.assertIn(buildDir, validBuilds(heights, pieces, x + moveDir[0], y + moveDir[1], pieceName))
+
+    def testMctsPlayerFindsWin(self):
+        pieces = self.setUpPieces(['O    ', '     ', '     ', '     ', ' OAB '])
+        heights = self.setUpHeights(['00000', '00000', '00000', '02024', '02204'])
+        random.seed(0)
+        pieceName, moveDir, buildDir = mctsPlayer(heights, pieces, False, iterations=500)
+
+        self.assertEqual((pieceName, moveDir), ('B', (-1, -1)))
+
+    def testMctsPlayerReusesSubtree(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     '])
+        heights = self.setUpHeights(['01000', '02100', '01020', '00100', '00000'])
+        pieceName, moveDir, buildDir = mctsPlayer(heights, pieces, False, iterations=300)
+        # Play the chosen move and then one of the replies that was explored.
+        position = Position.fromLists(heights, pieces)
+        x, y = findPiecePos(pieces, pieceName)
+        destX, destY = x + moveDir[0], y + moveDir[1]
+        move = (squareOf(x, y), squareOf(destX, destY), squareOf(destX + buildDir[0], destY + buildDir[1]))
+        position.applyMove(move)
+        reply = max(santorini._mctsSubtrees.values(), key=lambda node: node.visits)
+        position.applyMove(reply.move)
+        visitsBefore = reply.visits
+        mctsPlayer(position.toLists()[0], position.toLists()[1], False, iterations=100)
+
+        self.assertEqual(reply.visits, visitsBefore + 100)
+
+    def testDefensiveRolloutPolicy(self):
+        pieces = self.setUpPieces(['     ', ' A O ', '  O B', '     ', '     '])
+        win = Position.fromLists(self.setUpHeights(['30000', '02020', '00000', '00000', '00000']), pieces)
+        threat = Position.fromLists(self.setUpHeights(['00003', '00020', '00000', '00000', '00000']), pieces)
+        for seed in range(20):
+            random.seed(seed)
+            # Call the method under test.
+            self.assertEqual(defensiveRolloutPolicy(win), (6, 0, None))
+            move = defensiveRolloutPolicy(threat)
+            # The opponent on height 2 is stopped from climbing to the top corner.
+            self.assertEqual(move[2], 4)
+            self.assertIn(move, threat.generateMoves())
+
+    def testDefensiveRolloutMatchesSimulateGame(self):
+        position = Position.fromLists(self.setUpHeights(['01000', '02100', '01020', '00100', '00000']),
+                                      self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     ']))
+        before = position.copy()
+        for seed in range(10):
+            random.seed(seed)
+            # Call the method under test.
+            result = defensiveRollout(position)
+            random.seed(seed)
+            winner, moves = simulateGame([defensiveRolloutPolicy, defensiveRolloutPolicy], position.copy(), validate=True)
+
+            self.assertEqual(result, (winner, len(moves)))
+            self.assertEqual((position.hash, position.heights, position.workers), (before.hash, before.heights, before.workers))
+
+    def testGameRecordsRoundTrip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'games.sgr')
+        winners = []
+        with GameRecordWriter(path) as writer:
+            for seed in range(3):
+                random.seed(seed)
+                winners.append(playGame([tryToClimb, defensivePlayer], quiet=True, recordGame=writer.write))
+        # Call the method under test.
+        records = list(readGameRecords(path))
+
+        self.assertEqual([record.winner for record in records], winners)
+        self.assertEqual(records[0].names, ['tryToClimb', 'defensivePlayer'])
+        self.assertEqual(os.path.getsize(path), 4 + sum(len(record.encode()) for record in records))
+        for record in records:
+            self.assertEqual(GameRecord.decode(record.encode()), record)
+            self.assertEqual(len(record.encode()), 6 + len('tryToClimbdefensivePlayer') + 4 + len(record.moves))
+            # Replaying the moves ends with the winner climbing to the top.
+            turns = list(replayGame(record))
+            heights, pieces, playerIndex, (pieceName, moveDir, buildDir) = turns[-1]
+            x, y = findPiecePos(pieces, pieceName)
+            self.assertEqual((playerIndex, heights[y + moveDir[1]][x + moveDir[0]]), (record.winner, MAX_HEIGHT - 1))
+
+    def testGameRecordLongNamesAreCutBetweenCharacters(self):
+        path = os.path.join(tempfile.mkdtemp(), 'games.sgr')
+        longName = u'a' * 254 + u'\xe9'
+        with GameRecordWriter(path) as writer:
+            writer.write(GameRecord([longName, u'\xe9' * 200], [(0, 0), (4, 4), (0, 4), (4, 0)], [], None))
+            writer.write(GameRecord(['tryToClimb', 'defensivePlayer'], [(0, 0), (4, 4), (0, 4), (4, 0)], [], 1))
+        # Call the method under test.
+        records = list(readGameRecords(path))
+
+        self.assertEqual([record.names for record in records], [[u'a' * 254, u'\xe9' * 127], ['tryToClimb', 'defensivePlayer']])
+        self.assertEqual(records[1].winner, 1)
+
+    def testFastGameMatchesPlayGame(self):
+        for seed in range(5):
+            records = []
+            random.seed(seed)
+            winner = playGame([tryToClimb, defensivePlayer], quiet=True, recordGame=records.append)
+            random.seed(seed)
+            # Call the method under test.
+            fastWinner = playFastGame([tryToClimb, defensivePlayer], validate=True, recordGame=records.append)
+
+            self.assertEqual(fastWinner, winner)
+            self.assertEqual(records[1], records[0])
+
+    def testSimulateGameValidatesMoves(self):
+        position = Position.fromLists(self.setUpHeights(['01000', '02100', '01020', '00100', '00000']),
+                                      self.setUpPieces(['     ', ' A O ', '  O  ', '   B ', '     ']))
+        # Moving the first worker onto the other player's worker isn't allowed.
+        cheat = lambda position: (position.workers[position.toMove][0], position.workers[1 - position.toMove][0], 0)
+
+        self.assertEqual(simulateGame([cheat, climbingRolloutPolicy], position.copy(), validate=True), (1, []))
+        winner, moves = simulateGame([climbingRolloutPolicy, climbingRolloutPolicy], position)
+        # The game ends with the winner having just climbed to the top, or the loser stuck.
+        self.assertTrue(position.lastMoveWon() or len(position.generateMoves()) == 0)
+        self.assertEqual(winner, 1 - position.toMove)
+
+    def testTournamentIsDeterministic(self):
+        players = [randomPlayerWithValidation, tryToClimb, defensivePlayer]
+        score = runTournament(players, 4, processes=1, seed=7)
+
+        self.assertEqual(sum(score.values()), 12)
+        self.assertEqual(runTournament(players, 4, processes=1, seed=7), score)
+        self.assertEqual(runTournament(players, 4, processes=2, seed=7), score)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from santorini import EMPTY, Position, coordsOf, defensivePlayer, tryToClimb
+from server import MatchServer, playRemoteGame
+
+def slowPlayer(heights, pieces, setUp):
+    import time
+    time.sleep(0.5)
+    return tryToClimb(heights, pieces, setUp)
+
+def edgePlayer(heights, pieces, setUp):
+    """Keep to the two right hand columns, as low as possible, out of the way of scripted clients."""
+    if setUp:
+        return (4, 4) if pieces[4][4] == EMPTY else (4, 2)
+    position = Position.fromLists(heights, pieces)
+    moves = [move for move in position.generateMoves() if all(coordsOf(square)[0] >= 3 for square in move if square is not None)]
+    return position.describeMove(min(moves, key=lambda move: position.heights[move[1]]))
+
+class ServerTest(unittest.TestCase):
+    def runWithServer(self, test, **options):
+        """Run a coroutine test(server, connect) against a server listening on a Unix socket."""
+        path = os.path.join(tempfile.mkdtemp(), 'server.sock')
+
+        async def run():
+            server = MatchServer(processes=2, **options)
+            await server.start(path=path)
+
+            async def connect():
+                reader, writer = await asyncio.open_unix_connection(path)
+                self.assertTrue((await reader.readline()).startswith(b'HELLO '))
+                return reader, writer
+
+            try:
+                return await test(server, connect)
+            finally:
+                await server.close()
+
+        return asyncio.run(run())
+
+    def testConcurrentGames(self):
+        async def test(server, connect):
+            async def play(gameIndex):
+                reader, writer = await connect()
+                results = []
+                # Play a game from each side on the same connection.
+                for clientIndex in range(2):
+                    results.append(await playRemoteGame(reader, writer, defensivePlayer, 'climb', clientIndex))
+                writer.close()
+                return results
+            return await asyncio.gather(*[play(gameIndex) for gameIndex in range(200)]), server.gamesPlayed
+
+        results, gamesPlayed = self.runWithServer(test)
+        self.assertEqual(gamesPlayed, 400)
+        for result in sum(results, []):
+            self.assertEqual(result[0], 'RESULT')
+            self.assertIn(result[1], ['WIN', 'LOSS'])
+
+    def testTcp(self):
+        async def run():
+            server = MatchServer(processes=1)
+            host, port = await server.start()
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+                await reader.readline()
+                return await playRemoteGame(reader, writer, defensivePlayer, 'defensive')
+            finally:
+                await server.close()
+
+        self.assertEqual(asyncio.run(run())[0], 'RESULT')
+
+    def testBadLinesAndIllegalMoves(self):
+        async def test(server, connect):
+            reader, writer = await connect()
+            lines = []
+            async def exchange(line, replies):
+                writer.write(line.encode() + b'\n')
+                for reply in range(replies):
+                    lines.append((await reader.readline()).decode().strip())
+            await exchange('NEW nobody', 1)
+            await exchange('HELLO', 1)
+            await exchange('NEW climb FIRST 10', 3)
+            await exchange('SETUP 2', 1)
+            await exchange('SETUP 2 2', 2)
+            await exchange('SETUP 2 2', 1)
+            return lines
+
+        lines = self.runWithServer(test)
+        self.assertTrue(lines[0].startswith('ERROR Unknown engine'))
+        self.assertEqual(lines[1], 'ERROR Expected NEW or QUIT')
+        self.assertEqual(lines[2:5], ['GAME 0 10000', 'BOARD ' + '0' * 25 + ' ' + '.' * 25, 'TURN SETUP 10000'])
+        self.assertEqual(lines[5], 'ERROR Expected SETUP')
+        self.assertEqual(lines[6], 'BOARD ' + '0' * 25 + ' ' + '.' * 12 + 'A' + '.' * 12)
+        self.assertTrue(lines[7].startswith('TURN SETUP'))
+        self.assertTrue(lines[8].startswith('RESULT LOSS illegal move'))
+
+    def testIllegalMovesLose(self):
+        # Each script sets up A and B and then plays moves on the left of the board, ending with an
+        # illegal one.
+        scripts = [
+            # A move of more than one square.
+            (['0 0', '0 2'], ['A 4 0 0 3']),
+            # A build away from the worker.
+            (['0 0', '0 2'], ['A 1 0 0 3']),
+            # A climb from height 1 to height 3.
+            (['0 0', '0 2'], ['A 1 0 -1 0', 'A -1 0 0 1', 'B 1 0 0 -1', 'B -1 0 1 -1', 'A 1 1']),
+            # A move from height 2 onto a dome.
+            (['0 0', '1 2'], ['A 1 0 -1 0', 'A -1 0 0 1', 'B -1 0 0 -1', 'A 0 1 1 0', 'B 1 0 0 -1',
+                              'B -1 0 1 -1', 'B 1 0 0 -1', 'A 1 0 0 -1']),
+        ]
+
+        async def test(server, connect):
+            reader, writer = await connect()
+            results = []
+            for setUps, moves in scripts:
+                writer.write(b'NEW edge FIRST\n')
+                while True:
+                    words = (await reader.readline()).decode().split()
+                    if words[0] == 'TURN':
+                        writer.write('{} {}\n'.format(words[1], (setUps if words[1] == 'SETUP' else moves).pop(0)).encode())
+                    elif words[0] == 'RESULT':
+                        results.append((' '.join(words), moves))
+                        break
+            return results
+
+        for result, movesLeft in self.runWithServer(test, engines={'edge': edgePlayer}):
+            self.assertTrue(result.startswith('RESULT LOSS illegal move'), result)
+            self.assertEqual(movesLeft, [])
+
+    def testClocks(self):
+        async def test(server, connect):
+            reader, writer = await connect()
+            engineResult = await playRemoteGame(reader, writer, tryToClimb, 'slow', 0, 0.2)
+            # The client never answers.
+            writer.write(b'NEW climb FIRST 0.2\n')
+            while True:
+                words = (await reader.readline()).decode().split()
+                if words[0] == 'RESULT':
+                    return engineResult, words
+
+        engineResult, clientResult = self.runWithServer(test, engines={'slow': slowPlayer, 'climb': tryToClimb})
+        self.assertEqual(engineResult, ['RESULT', 'WIN', 'out', 'of', 'time'])
+        self.assertEqual(clientResult, ['RESULT', 'LOSS', 'out', 'of', 'time'])
+
+if __name__ == '__main__':
+    unittest.main()
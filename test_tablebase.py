@@ -0,0 +1,98 @@
+import os
+import random
+import tempfile
+import unittest
+import santorini
+from santorini import *
+from tablebase import buildTablebase
+
+class TablebaseTest(unittest.TestCase):
+    # The open squares of a small layout: a row of three with two squares below it.
+    LAYOUT = sum(1 << square for square in [6, 7, 8, 12, 13])
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'tablebase.bin')
+        writeTablebase(buildTablebase([self.LAYOUT], 5), 5, path)
+        self.tablebase = Tablebase(path)
+
+    def randomPositions(self, count):
+        rng = random.Random(0)
+        squares = list(bitsOf(self.LAYOUT))
+        positions = []
+        while len(positions) < count:
+            heights = [MAX_HEIGHT] * 25
+            for square in squares:
+                heights[square] = rng.randrange(MAX_HEIGHT)
+            workers = rng.sample(squares, 4)
+            if all(heights[square] < MAX_HEIGHT - 1 for square in workers):
+                positions.append(Position(heights, [workers[:2], workers[2:]]).transformed(rng.randrange(8)))
+        return positions
+
+    def testResultsMatchFullSearch(self):
+        for position in self.randomPositions(100):
+            self.assertTrue(self.tablebase.covers(position))
+            won, plies = self.tablebase.probe(position)
+
+            self.assertEqual(searchNegamax(position, 25, -1000, 1000), 1000 if won else -1000)
+            self.assertEqual(searchNegamax(position, plies + 1, -1000, 1000), 1000 if won else -1000)
+
+    def testSearchProbesTablebase(self):
+        position = self.randomPositions(1)[0]
+        expected = searchNegamax(position, 25, -1000, 1000)
+        stats = SearchStats()
+        santorini.ENDGAME_TABLEBASE = self.tablebase
+        try:
+            score = searchNegamax(position, 0, -1000, 1000, stats=stats)
+        finally:
+            santorini.ENDGAME_TABLEBASE = None
+
+        self.assertEqual(score, expected)
+        self.assertEqual(stats.tablebaseHits, 1)
+
+    def testBatchedFrontierUsesTablebase(self):
+        # Positions with one more open square, on height 3 next to the layout, so that they aren't
+        # covered but a build there leaves a position that is.
+        rng = random.Random(0)
+        squares = list(bitsOf(self.LAYOUT))
+        positions = []
+        while len(positions) < 20:
+            heights = [MAX_HEIGHT] * 25
+            heights[14] = MAX_HEIGHT - 1
+            for square in squares:
+                heights[square] = rng.randrange(MAX_HEIGHT - 1)
+            workers = rng.sample(squares, 4)
+            position = Position(heights, [workers[:2], workers[2:]])
+            if not position.hasWinningMove():
+                positions.append(position)
+        santorini.ENDGAME_TABLEBASE = self.tablebase
+        tablebaseHits = 0
+        try:
+            for position in positions:
+                self.assertFalse(self.tablebase.covers(position))
+                batchStats, stats = SearchStats(), SearchStats()
+                # Call the method under test.
+                score = searchFrontier(position, batchStats)[0]
+                expected = searchNegamax(position, 1, -1000, 1000, stats=stats)
+
+                self.assertEqual(score, expected)
+                if santorini.numpy is not None:
+                    # searchNegamax only batches with numpy.
+                    santorini.BATCH_FRONTIER = True
+                    try:
+                        self.assertEqual(searchNegamax(position, 1, -1000, 1000), expected)
+                    finally:
+                        santorini.BATCH_FRONTIER = False
+                if expected == 1000:
+                    # The search stopped at the first move that wins, so it saw fewer children.
+                    continue
+                # The search visits the children that beat a null window again.
+                self.assertEqual(batchStats.nodesByDepth[0], stats.nodesByDepth[0] - stats.researches)
+                self.assertEqual((batchStats.tablebaseHits, batchStats.expandedNodes, batchStats.childrenSearched),
+                                 (stats.tablebaseHits, stats.expandedNodes, stats.childrenSearched))
+                tablebaseHits += stats.tablebaseHits
+        finally:
+            santorini.ENDGAME_TABLEBASE = None
+        self.assertTrue(tablebaseHits > 0)
+
+if __name__ == '__main__':
+    unittest.main()